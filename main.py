@@ -9,12 +9,14 @@ import time
 import torch
 import numpy as np
 
-from rcbf_sac.generate_rollouts import generate_model_rollouts
+from rcbf_sac.generate_rollouts import generate_model_rollouts, ModelRolloutStep
 from rcbf_sac.sac_cbf import RCBF_SAC
-from rcbf_sac.replay_memory import ReplayMemory
+from rcbf_sac.replay_memory import ReplayMemory, DiskReplayMemory, PrioritizedReplayMemory, TrajectoryReplayMemory, GenerationalReplayMemory
+from rcbf_sac.replay_prefetcher import ReplayPrefetcher
 from rcbf_sac.dynamics import DynamicsModel
 from build_env import *
 import os
+from contextlib import nullcontext
 
 from rcbf_sac.utils import prGreen, get_output_folder, prYellow
 
@@ -26,13 +28,39 @@ def train(agent, env, dynamics_model, args, experiment=None):
         agent.load_weights(args.resume)
 
     # Memory
-    memory = ReplayMemory(args.replay_size, args.seed)
-    memory_model = ReplayMemory(args.replay_size, args.seed)
+    if args.replay_on_disk:
+        memory = DiskReplayMemory(args.replay_size, args.seed, args.output, 'memory', tail_size=args.replay_tail_size, compress=args.replay_compress)
+        memory_model = DiskReplayMemory(args.replay_size, args.seed, args.output, 'memory_model', tail_size=args.replay_tail_size, compress=args.replay_compress)
+    elif args.prioritized_replay:  # Only the real transitions are prioritized
+        memory = PrioritizedReplayMemory(args.replay_size, args.seed, alpha=args.per_alpha, beta=args.per_beta, compress=args.replay_compress)
+        memory_model = ReplayMemory(args.replay_size, args.seed, compress=args.replay_compress)
+    elif args.replay_trajectory:  # Model rollouts are independent transitions, so only the real buffer stores trajectories
+        memory = TrajectoryReplayMemory(args.replay_size, args.seed, compress=args.replay_compress)
+        memory_model = ReplayMemory(args.replay_size, args.seed, compress=args.replay_compress)
+    else:
+        memory = ReplayMemory(args.replay_size, args.seed, compress=args.replay_compress)
+        memory_model = ReplayMemory(args.replay_size, args.seed, compress=args.replay_compress)
+    if args.model_retention > 0:  # Only keep the model rollouts generated in the last model_retention steps / GP fits
+        memory_model = GenerationalReplayMemory(args.model_replay_size or args.replay_size, args.seed, args.model_retention, compress=args.replay_compress)
 
     # Training Loop
     total_numsteps = 0
     updates = 0
 
+    # Load the replay buffers too if they were saved with the weights, so we don't have to redo the warmup
+    if hasattr(args, 'load_agent') and memory.load(args.resume, 'memory'):
+        memory_model.load(args.resume, 'memory_model')
+        total_numsteps = len(memory)
+        prGreen('Loaded replay buffers: real : {}, model : {}'.format(len(memory), len(memory_model)))
+
+    # Sample training batches in a background thread, the buffers must then only be modified while holding its lock
+    prefetcher = None
+    if args.prefetch:
+        prefetcher = ReplayPrefetcher(memory, memory_model if args.model_based else None, args.batch_size, agent.device, queue_depth=args.prefetch_depth)
+    buffer_lock = prefetcher.lock if prefetcher else nullcontext()
+
+    rollout_step = ModelRolloutStep(env, dynamics_model, batch_size=5 * args.rollout_batch_size) if args.model_based and args.fused_rollouts else None
+
     if args.use_comp:
         compensator_rollouts = []
         comp_buffer_idx = 0
@@ -57,10 +85,16 @@ def train(agent, env, dynamics_model, args, experiment=None):
             state = dynamics_model.get_state(obs)
             # Generate Model rollouts
             if args.model_based and episode_steps % 5 == 0 and len(memory) > dynamics_model.max_history_count / 3:
-                memory_model = generate_model_rollouts(env, memory_model, memory, agent, dynamics_model,
-                                                       k_horizon=args.k_horizon,
-                                                       batch_size=min(len(memory), 5 * args.rollout_batch_size),
-                                                       warmup=args.start_steps > total_numsteps)
+                with buffer_lock:
+                    if args.model_retention > 0:
+                        n_evicted = memory_model.set_generation(dynamics_model.gp_generation if args.model_retention_unit == 'gp_fits' else total_numsteps)
+                        if n_evicted and prefetcher:
+                            prefetcher.invalidate()
+                    memory_model = generate_model_rollouts(env, memory_model, memory, agent, dynamics_model,
+                                                           k_horizon=args.k_horizon,
+                                                           batch_size=min(len(memory), 5 * args.rollout_batch_size),
+                                                           warmup=args.start_steps > total_numsteps,
+                                                           rollout_step=rollout_step)
 
             # If using model-based RL then we only need to have enough data for the real portion of the replay buffer
             if len(memory) + len(memory_model) * args.model_based > args.batch_size:
@@ -73,18 +107,22 @@ def train(agent, env, dynamics_model, args, experiment=None):
                         # Pick the ratio of data to be sampled from the real vs model buffers
                         real_ratio = max(min(args.real_ratio, len(memory) / args.batch_size),
                                          1 - len(memory_model) / args.batch_size)
+                        if prefetcher:
+                            prefetcher.real_ratio = real_ratio
                         # Update parameters of all the networks
                         critic_1_loss, critic_2_loss, policy_loss, ent_loss, alpha = agent.update_parameters(memory,
                                                                                                              args.batch_size,
                                                                                                              updates,
                                                                                                              dynamics_model,
                                                                                                              memory_model,
-                                                                                                             real_ratio)
+                                                                                                             real_ratio,
+                                                                                                             prefetcher=prefetcher)
                     else:
                         critic_1_loss, critic_2_loss, policy_loss, ent_loss, alpha = agent.update_parameters(memory,
                                                                                                          args.batch_size,
                                                                                                          updates,
-                                                                                                         dynamics_model)
+                                                                                                         dynamics_model,
+                                                                                                         prefetcher=prefetcher)
 
                     if experiment:
                         # experiment.log_metric('loss/critic_1', critic_1_loss, updates)
@@ -93,6 +131,8 @@ def train(agent, env, dynamics_model, args, experiment=None):
                         # experiment.log_metric('loss/entropy_loss', ent_loss, step=updates)
                         # experiment.log_metric('entropy_temperature/alpha', alpha, step=updates)
                         wandb.log({'loss/critic_1': critic_1_loss, 'loss/critic_2': critic_2_loss, 'loss/policy': policy_loss, 'loss/entropy_loss': ent_loss, 'entropy_temperature/alpha': alpha, 'Steps':updates})
+                        if prefetcher:
+                            wandb.log({'replay/prefetch_queue_depth': prefetcher.qsize(), 'Steps': updates})
                     updates += 1
 
             # Sample action from policy
@@ -115,18 +155,28 @@ def train(agent, env, dynamics_model, args, experiment=None):
             # (https://github.com/openai/spinningup/blob/master/spinup/algos/sac/sac.py)
             mask = 1 if episode_steps == env.max_episode_steps else float(not done)
 
-            if args.use_comp:  # action is (rl_action + cbf_action + comp_action)
-                memory.push(obs, action-cbf_action-comp_action, reward, next_obs, mask, t=episode_steps * env.dt, next_t=(episode_steps+1) * env.dt, cbf_info=info.get('cbf_info', None), next_cbf_info=next_info.get('cbf_info', None))  # Append transition to memory
-            elif args.cbf_mode == 'baseline':  # action is (rl_action + cbf_action)
-                memory.push(obs, action-cbf_action, reward, next_obs, mask, t=episode_steps * env.dt, next_t=(episode_steps+1) * env.dt, cbf_info=info.get('cbf_info', None), next_cbf_info=next_info.get('cbf_info', None))  # Append transition to memory
-            else:
-                memory.push(obs, action, reward, next_obs, mask, t=episode_steps * env.dt, next_t=(episode_steps+1) * env.dt, cbf_info=info.get('cbf_info', None), next_cbf_info=next_info.get('cbf_info', None))  # Append transition to memory
+            with buffer_lock:
+                if args.use_comp:  # action is (rl_action + cbf_action + comp_action)
+                    memory.push(obs, action-cbf_action-comp_action, reward, next_obs, mask, t=episode_steps * env.dt, next_t=(episode_steps+1) * env.dt, cbf_info=info.get('cbf_info', None), next_cbf_info=next_info.get('cbf_info', None))  # Append transition to memory
+                elif args.cbf_mode == 'baseline':  # action is (rl_action + cbf_action)
+                    memory.push(obs, action-cbf_action, reward, next_obs, mask, t=episode_steps * env.dt, next_t=(episode_steps+1) * env.dt, cbf_info=info.get('cbf_info', None), next_cbf_info=next_info.get('cbf_info', None))  # Append transition to memory
+                else:
+                    memory.push(obs, action, reward, next_obs, mask, t=episode_steps * env.dt, next_t=(episode_steps+1) * env.dt, cbf_info=info.get('cbf_info', None), next_cbf_info=next_info.get('cbf_info', None))  # Append transition to memory
 
             # Update state and store transition for GP model learning
             next_state = dynamics_model.get_state(next_obs)
             if episode_steps % 2 == 0 and i_episode < args.gp_max_episodes:  # Stop learning the dynamics after a while to stabilize learning
                 # TODO: Clean up line below, specifically (t_batch)
+                gp_generation = dynamics_model.gp_generation
                 dynamics_model.append_transition(state, action, next_state, t_batch=np.array([episode_steps*env.dt]))
+                if experiment and dynamics_model.gp_generation > gp_generation and dynamics_model.gp_fit_iters:
+                    wandb.log({'gp/fit_iters': max(dynamics_model.gp_fit_iters), 'Steps': total_numsteps})
+                if experiment and dynamics_model.gp_generation > gp_generation and args.gp_incremental:
+                    wandb.log({'gp/posterior_updates': dynamics_model.gp_posterior_updates, 'gp/posterior_resets': dynamics_model.gp_posterior_resets, 'Steps': total_numsteps})
+                if experiment and dynamics_model.gp_generation > gp_generation and args.gp_history_voxel:
+                    wandb.log({'gp/history_duplicates': dynamics_model.history_duplicates, 'Steps': total_numsteps})
+                if experiment and dynamics_model.gp_generation > gp_generation and dynamics_model.gp_grid_error:
+                    wandb.log({'gp/grid_max_error_mean': dynamics_model.gp_grid_error[0], 'gp/grid_max_error_std': dynamics_model.gp_grid_error[1], 'Steps': total_numsteps})
 
             # append comp rollout with step before updating
             if args.use_comp:
@@ -151,6 +201,9 @@ def train(agent, env, dynamics_model, args, experiment=None):
         if i_episode > 0 and i_episode % 20 == 0:
             agent.save_model(args.output)
             dynamics_model.save_disturbance_models(args.output)
+            with buffer_lock:
+                memory.save(args.output, 'memory')
+                memory_model.save(args.output, 'memory_model')
 
         if experiment:
             # # Comet.ml logging
@@ -164,6 +217,8 @@ def train(agent, env, dynamics_model, args, experiment=None):
         # Evaluation
         if i_episode % 1 == 0 and args.eval is True: # was 5
             print('Size of replay buffers: real : {}, \t\t model : {}'.format(len(memory), len(memory_model)))
+            if prefetcher:
+                print('Prefetched batches in queue: {}'.format(prefetcher.qsize()))
             avg_reward = 0.
             avg_cost = 0.
             episodes = 3
@@ -194,6 +249,10 @@ def train(agent, env, dynamics_model, args, experiment=None):
             print("Test Episodes: {}, Avg. Reward: {}, Avg. Cost: {}".format(episodes, round(avg_reward, 2), round(avg_cost, 2)))
             print("----------------------------------------")
 
+    if prefetcher:
+        prefetcher.close()
+    dynamics_model.wait_for_fit()
+
 
 def test(agent, dynamics_model, args, visualize=True, debug=True):
 
@@ -303,6 +362,30 @@ if __name__ == "__main__":
                         help='Value target update per no. of updates per step (default: 1)')
     parser.add_argument('--replay_size', type=int, default=10000000, metavar='N',
                         help='size of replay buffer (default: 10000000)')
+    parser.add_argument('--replay_on_disk', action='store_true', dest='replay_on_disk',
+                        help='Store the replay buffers as memmaps in the output folder instead of RAM.')
+    parser.add_argument('--replay_tail_size', type=int, default=10000, metavar='N',
+                        help='Number of recent transitions kept in RAM when using --replay_on_disk (default: 10000)')
+    parser.add_argument('--replay_compress', action='store_true', dest='replay_compress',
+                        help='Store observations and actions as float16 and masks as uint8 in the replay buffers.')
+    parser.add_argument('--replay_trajectory', action='store_true', dest='replay_trajectory',
+                        help='Store the real transitions as trajectories so each observation is only stored once.')
+    parser.add_argument('--prioritized_replay', action='store_true', dest='prioritized_replay',
+                        help='Sample real transitions proportionally to their TD error.')
+    parser.add_argument('--per_alpha', type=float, default=0.6, metavar='G',
+                        help='Prioritization exponent of prioritized replay (default: 0.6)')
+    parser.add_argument('--per_beta', type=float, default=0.4, metavar='G',
+                        help='Importance-sampling exponent of prioritized replay (default: 0.4)')
+    parser.add_argument('--model_retention', type=int, default=0, metavar='N',
+                        help='Evict model rollouts older than N env steps or GP fits, 0 keeps them all (default: 0)')
+    parser.add_argument('--model_retention_unit', default='gp_fits', type=str, choices=['gp_fits', 'steps'],
+                        help='Unit of --model_retention (default: gp_fits)')
+    parser.add_argument('--model_replay_size', type=int, default=None, metavar='N',
+                        help='Size of the model replay buffer when using --model_retention (default: replay_size)')
+    parser.add_argument('--prefetch', action='store_true', dest='prefetch',
+                        help='Sample training batches in a background thread.')
+    parser.add_argument('--prefetch_depth', type=int, default=4, metavar='N',
+                        help='Max number of prefetched batches waiting in the queue (default: 4)')
     parser.add_argument('--cuda', action="store_true",
                         help='run on CUDA (default: False)')
     parser.add_argument('--device_num', type=int, default=0, help='Select GPU number for CUDA (default: 0)')
@@ -311,6 +394,28 @@ if __name__ == "__main__":
     parser.add_argument('--validate_steps', default=1000, type=int, help='how many steps to perform a validate experiment')
     # CBF, Dynamics, Env Args
     parser.add_argument('--gp_model_size', default=2000, type=int, help='gp')
+    parser.add_argument('--gp_batched', action='store_true', dest='gp_batched',
+                        help='Fit the GPs of all state dimensions as one batched GP (faster on GPU).')
+    parser.add_argument('--gp_incremental', action='store_true', dest='gp_incremental',
+                        help='Condition the GPs on every new transition in between hyperparameter refits.')
+    parser.add_argument('--gp_backend', default='exact', type=str, choices=['exact', 'svgp', 'rff'],
+                        help='Exact GPs, sparse variational GPs trained on minibatches for large --gp_model_size, or '
+                             'regression on random Fourier features with constant prediction cost (default: exact)')
+    parser.add_argument('--gp_num_inducing', type=int, default=256, metavar='N',
+                        help='Number of inducing points of the svgp backend (default: 256)')
+    parser.add_argument('--gp_num_features', type=int, default=256, metavar='N',
+                        help='Number of random Fourier features of the rff backend (default: 256)')
+    parser.add_argument('--gp_async', action='store_true', dest='gp_async',
+                        help='Refit the GPs in a background thread while the old ones keep being used.')
+    parser.add_argument('--gp_grid_size', type=int, default=0, metavar='N',
+                        help='Unicycle only: predict the disturbance by interpolating the GPs tabulated on an N^3 (x, y, theta) grid, 0 disables it (default: 0)')
+    parser.add_argument('--gp_warm_start', action='store_true', dest='gp_warm_start',
+                        help='Start each GP refit from the previous hyperparameters and optimizer state.')
+    parser.add_argument('--gp_tol', type=float, default=None, metavar='G',
+                        help='Stop GP training once the loss changes by less than this between iterations (default: None)')
+    parser.add_argument('--gp_history_voxel', type=float, default=0., metavar='G',
+                        help='Keep a single (the latest) point per voxel of this size in normalized state units in the GP '
+                             'history instead of a FIFO of near-duplicates, 0 disables it (default: 0)')
     parser.add_argument('--gp_max_episodes', default=100, type=int, help='gp max train episodes.')
     parser.add_argument('--k_d', default=3.0, type=float)
     parser.add_argument('--gamma_b', default=20, type=float)
@@ -321,6 +426,8 @@ if __name__ == "__main__":
     parser.add_argument('--real_ratio', default=0.3, type=float, help='Portion of data obtained from real replay buffer for training.')
     parser.add_argument('--k_horizon', default=1, type=int, help='horizon of model-based rollouts')
     parser.add_argument('--rollout_batch_size', default=5, type=int, help='Size of initial states batch to rollout from.')
+    parser.add_argument('--fused_rollouts', action='store_true', dest='fused_rollouts',
+                        help='Predict the model rollout steps with in-place operations on preallocated buffers (Unicycle and SimulatedCars).')
     # Modular Task Learning
     parser.add_argument('--cbf_mode', default='mod', help="Options are `off`, `baseline`, `full`, `mod`.")
     # Compensator
@@ -357,6 +464,18 @@ if __name__ == "__main__":
     if args.mode == 'train':
         if args.use_comp and (args.model_based or args.cbf_mode != "baseline"):
             raise Exception('Compensator can only be used with model free RL and baseline CBF.')
+        if args.prioritized_replay and args.replay_on_disk:
+            raise Exception('Prioritized replay is not supported with --replay_on_disk.')
+        if args.replay_trajectory and (args.prioritized_replay or args.replay_on_disk):
+            raise Exception('--replay_trajectory can\'t be combined with --prioritized_replay or --replay_on_disk.')
+        if args.gp_backend == 'svgp' and (args.gp_batched or args.gp_incremental):
+            raise Exception('--gp_backend svgp can\'t be combined with --gp_batched or --gp_incremental.')
+        if args.gp_backend == 'rff' and args.gp_batched:
+            raise Exception('--gp_backend rff can\'t be combined with --gp_batched.')
+        if args.gp_grid_size and args.gp_incremental:
+            raise Exception('--gp_grid_size can\'t be combined with --gp_incremental, the grid is only rebuilt on refits.')
+        if args.model_retention > 0 and args.replay_on_disk:
+            raise Exception('--model_retention is not supported with --replay_on_disk.')
         args.output = get_output_folder(args.output, args.env_name)
         if args.log_wandb:
             import random
@@ -1,7 +1,7 @@
 import argparse
 import numpy as np
 import torch
-from rcbf_sac.dynamics import DYNAMICS_MODE
+from rcbf_sac.dynamics import DYNAMICS_MODE, get_nominal_dynamics
 from rcbf_sac.utils import to_tensor, to_numpy, prRed, get_polygon_normals, sort_vertices_cclockwise
 from time import time
 from qpth.qp import QPFunction
@@ -24,6 +24,7 @@ class CBFQPLayer:
         self.device = torch.device("cuda" if args.cuda else "cpu")
 
         self.env = env
+        self.get_f, self.get_g = get_nominal_dynamics(self.env.dynamics_mode)
         self.u_min, self.u_max = self.get_control_bounds()
         self.gamma_b = gamma_b
 
@@ -216,29 +217,22 @@ class CBFQPLayer:
             ps[:, 0] = state_batch[:, 0, :].squeeze(-1) + l_p * c_thetas
             ps[:, 1] = state_batch[:, 1, :].squeeze(-1) + l_p * s_thetas
 
-            # p_dot(x) = f_p(x) + g_p(x)u + D_p where f_p(x) = 0,  g_p(x) = RL and D_p is the disturbance
-
-            # f_p(x) = [0,...,0]^T
-            f_ps = torch.zeros((batch_size, 2, 1)).to(self.device)
-
-            # g_p(x) = RL where L = diag([1, l_p])
-            Rs = torch.zeros((batch_size, 2, 2)).to(self.device)
-            Rs[:, 0, 0] = c_thetas
-            Rs[:, 0, 1] = -s_thetas
-            Rs[:, 1, 0] = s_thetas
-            Rs[:, 1, 1] = c_thetas
-            Ls = torch.zeros((batch_size, 2, 2)).to(self.device)
-            Ls[:, 0, 0] = 1
-            Ls[:, 1, 1] = l_p
-            g_ps = torch.bmm(Rs, Ls)  # (batch_size, 2, 2)
-
-            # D_p(x) = g_p [0 D_θ]^T + [D_x1 D_x2]^T
-            mu_theta_aug = torch.zeros([batch_size, 2, 1]).to(self.device)
-            mu_theta_aug[:, 1, :] = mean_pred_batch[:, 2, :]
-            mu_ps = torch.bmm(g_ps, mu_theta_aug) + mean_pred_batch[:, :2, :]
-            sigma_theta_aug = torch.zeros([batch_size, 2, 1]).to(self.device)
-            sigma_theta_aug[:, 1, :] = sigma_pred_batch[:, 2, :]
-            sigma_ps = torch.bmm(torch.abs(g_ps), sigma_theta_aug) + sigma_pred_batch[:, :2, :]
+            # p_dot(x) = f_p(x) + g_p(x)u + D_p = J_p(x) (f(x) + g(x)u + D) where J_p = dp/dx is the jacobian of p(x)
+            Js = torch.zeros((batch_size, 2, 3)).to(self.device)
+            Js[:, 0, 0] = 1
+            Js[:, 0, 2] = -l_p * s_thetas
+            Js[:, 1, 1] = 1
+            Js[:, 1, 2] = l_p * c_thetas
+
+            # f_p(x) = J_p f(x) = [0,...,0]^T
+            f_ps = torch.bmm(Js, self.get_f(state_batch[:, :, 0]).unsqueeze(-1))
+
+            # g_p(x) = J_p g(x) = RL where L = diag([1, l_p])
+            g_ps = torch.bmm(Js, self.get_g(state_batch[:, :, 0]))  # (batch_size, 2, 2)
+
+            # D_p(x) = J_p D = g_p [0 D_θ]^T + [D_x1 D_x2]^T
+            mu_ps = torch.bmm(Js, mean_pred_batch)
+            sigma_ps = torch.bmm(torch.abs(Js), sigma_pred_batch)
 
             # Build RCBFs
             hs = 1e3 * torch.ones((batch_size, num_cbfs), device=self.device)  # the RCBF itself
@@ -337,10 +331,10 @@ class CBFQPLayer:
             ps[:, 0] = state_batch[:, 0, :].squeeze(-1)
             ps[:, 1] = state_batch[:, 1, :].squeeze(-1)
 
-            # velocities
-            vs = torch.zeros((batch_size, 2)).to(self.device)
-            vs[:, 0] = state_batch[:, 3, :].squeeze(-1)
-            vs[:, 1] = state_batch[:, 4, :].squeeze(-1)
+            # Velocity p_d and acceleration p_dd of the position, given by the nominal drift f(x)
+            f_x = self.get_f(state_batch[:, :, 0])
+            vs = f_x[:, :2]
+            accs = f_x[:, 3:5]
 
             # Thrust
             thrusts = state_batch[:, 5, :].squeeze(-1)
@@ -358,7 +352,7 @@ class CBFQPLayer:
             G[:, 0, 0] = s_thetas  # thrust_derivative
             G[:, 0, 1] = c_thetas * thrusts  # omega
             G[:, 0, n_u] = -1  # for slack
-            h[:, 0] = (gamma+gamma_2+gamma_3)*(-s_thetas * thrusts)
+            h[:, 0] = (gamma+gamma_2+gamma_3)*(accs[:, 0])
             h[:, 0] += (gamma_3*(gamma_2 + gamma) + gamma_2 * gamma)*(vs[:, 0])
             h[:, 0] += gamma * gamma_2 * gamma_3 * (ps[:, 0] - self.env.bds[0, 0] - buffer) - (s_thetas * action_batch[:, 0, 0] + c_thetas * thrusts * action_batch[:, 1, 0])
             ineq_constraint_counter += 1
@@ -368,7 +362,7 @@ class CBFQPLayer:
             G[:, 1, 0] = -s_thetas  # thrust_derivative
             G[:, 1, 1] = -c_thetas * thrusts  # omega
             G[:, 1, n_u] = -1  # for slack
-            h[:, 1] = (gamma+gamma_2+gamma_3)*(s_thetas * thrusts)
+            h[:, 1] = (gamma+gamma_2+gamma_3)*(-accs[:, 0])
             h[:, 1] += (gamma_3*(gamma_2 + gamma) + gamma_2 * gamma)*(-vs[:, 0])
             h[:, 1] += gamma * gamma_2 * gamma_3 * (self.env.bds[1, 0] - ps[:, 0] - buffer) + (s_thetas * action_batch[:, 0, 0] + c_thetas * thrusts * action_batch[:, 1, 0])
             ineq_constraint_counter += 1
@@ -378,7 +372,7 @@ class CBFQPLayer:
             G[:, 2, 0] = -c_thetas  # thrust_derivative
             G[:, 2, 1] = s_thetas * thrusts  # omega
             G[:, 2, n_u] = -1  # for slack
-            h[:, 2] = (gamma+gamma_2+gamma_3)*(c_thetas * thrusts - 1)  # hdd
+            h[:, 2] = (gamma+gamma_2+gamma_3)*(accs[:, 1])  # hdd
             h[:, 2] += (gamma_3*(gamma_2 + gamma) + gamma_2 * gamma)*(vs[:, 1])  # hd
             h[:, 2] += gamma * gamma_2 * gamma_3 * (ps[:, 1] - self.env.bds[0, 1] - buffer) + (c_thetas * action_batch[:, 0, 0] - s_thetas * thrusts * action_batch[:, 1, 0])  # h
             ineq_constraint_counter += 1
@@ -388,7 +382,7 @@ class CBFQPLayer:
             G[:, 3, 0] = c_thetas  # thrust_derivative
             G[:, 3, 1] = -s_thetas * thrusts  # omega
             G[:, 3, n_u] = -1  # for slack
-            h[:, 3] = (gamma+gamma_2+gamma_3)*(-c_thetas * thrusts + 1)  # hdd
+            h[:, 3] = (gamma+gamma_2+gamma_3)*(-accs[:, 1])  # hdd
             h[:, 3] += (gamma_3*(gamma_2 + gamma) + gamma_2 * gamma)*(-vs[:, 1])  # hd
             h[:, 3] += gamma * gamma_2 * gamma_3 * (self.env.bds[1, 1] - ps[:, 1] - buffer) + (-c_thetas * action_batch[:, 0, 0] + s_thetas * thrusts * action_batch[:, 1, 0]) # h
             ineq_constraint_counter += 1
@@ -415,7 +409,7 @@ class CBFQPLayer:
                 G[:, 6, 0] = s_thetas  # thrust_derivative
                 G[:, 6, 1] = c_thetas * thrusts  # omega
                 G[:, 6, n_u] = -1  # for slack
-                h[:, 6] = (gamma + gamma_2 + gamma_3) * (-s_thetas * thrusts)
+                h[:, 6] = (gamma + gamma_2 + gamma_3) * (accs[:, 0])
                 h[:, 6] += (gamma_3 * (gamma_2 + gamma) + gamma_2 * gamma) * (vs[:, 0])
                 h[:, 6] += gamma * gamma_2 * gamma_3 * (ps[:, 0] - (cbf_info_batch[:, 0] - self.env.operator_dist)) - (
                             s_thetas * action_batch[:, 0, 0] + c_thetas * thrusts * action_batch[:, 1, 0])
@@ -426,7 +420,7 @@ class CBFQPLayer:
                 G[:, 7, 0] = -s_thetas  # thrust_derivative
                 G[:, 7, 1] = -c_thetas * thrusts  # omega
                 G[:, 7, n_u] = -1  # for slack
-                h[:, 7] = (gamma + gamma_2 + gamma_3) * (s_thetas * thrusts)
+                h[:, 7] = (gamma + gamma_2 + gamma_3) * (-accs[:, 0])
                 h[:, 7] += (gamma_3 * (gamma_2 + gamma) + gamma_2 * gamma) * (-vs[:, 0])
                 h[:, 7] += gamma * gamma_2 * gamma_3 * ((cbf_info_batch[:, 0] + self.env.operator_dist) - ps[:, 0]) + (
                             s_thetas * action_batch[:, 0, 0] + c_thetas * thrusts * action_batch[:, 1, 0])
@@ -441,8 +435,8 @@ class CBFQPLayer:
                     G[:, ineq_constraint_counter, 0] = -(rel_vecs[:, 0] * -s_thetas + rel_vecs[:, 1] * c_thetas)
                     G[:, ineq_constraint_counter, 1] = -thrusts * (rel_vecs[:, 0] * -c_thetas + rel_vecs[:, 1] * -s_thetas)
                     G[:, ineq_constraint_counter, n_u + 3] = -1
-                    h[:, ineq_constraint_counter] = 3*(vs[:, 0] * -s_thetas * thrusts + vs[:, 1] * (c_thetas * thrusts - 1))  # hddd
-                    h[:, ineq_constraint_counter] += (gamma * gamma_2 * gamma_3) * (torch.sum(vs**2, dim=1) + rel_vecs[:, 0] * -s_thetas*thrusts + rel_vecs[:, 1]*(c_thetas * thrusts - 1))
+                    h[:, ineq_constraint_counter] = 3*torch.sum(vs * accs, dim=1)  # hddd
+                    h[:, ineq_constraint_counter] += (gamma * gamma_2 * gamma_3) * (torch.sum(vs**2, dim=1) + torch.sum(rel_vecs * accs, dim=1))
                     h[:, ineq_constraint_counter] += (gamma_3 * (gamma_2 + gamma) + gamma_2 * gamma) * (rel_vecs[:, 0] * vs[:, 0] + rel_vecs[:, 1] * vs[:, 1])
                     h[:, ineq_constraint_counter] += 0.5 * gamma_3 * gamma_2 * gamma * (torch.sum(rel_vecs**2, dim=1) - (1.05*hazards_radius[i])**2 - (1.3*buffer)**2)
                     h[:, ineq_constraint_counter] += (rel_vecs[:, 0] * -s_thetas + rel_vecs[:, 1] * c_thetas) * action_batch[:, 0, 0]
@@ -471,28 +465,14 @@ class CBFQPLayer:
             pos = state_batch[:, ::2, 0]
             vels = state_batch[:, 1::2, 0]
 
-            # Action (acceleration)
-            vels_des = 30.0 * torch.ones((state_batch.shape[0], 5)).to(self.device)  # Desired velocities
-            # vels_des[:, 0] -= 10 * torch.sin(0.2 * t_batch)
-            accels = self.env.kp * (vels_des - vels)
-            accels[:, 1] -= self.env.k_brake * (pos[:, 0] - pos[:, 1]) * ((pos[:, 0] - pos[:, 1]) < 6.0)
-            accels[:, 2] -= self.env.k_brake * (pos[:, 1] - pos[:, 2]) * ((pos[:, 1] - pos[:, 2]) < 6.0)
-            accels[:, 3] = 0.0  # Car 4's acceleration is controlled directly
-            accels[:, 4] -= self.env.k_brake * (pos[:, 2] - pos[:, 4]) * ((pos[:, 2] - pos[:, 4]) < 13.0)
-
-            # f(x)
-            f_x = torch.zeros((state_batch.shape[0], state_batch.shape[1])).to(self.device)
-            f_x[:, ::2] = vels
-            f_x[:, 1::2] = accels
+            # f(x) and g(x), without the time-varying desired velocity of the lead car
+            f_x = self.get_f(state_batch[:, :, 0])
+            g_x = self.get_g(state_batch[:, :, 0])
 
             # f_D(x) - disturbance in the drift dynamics
             fD_x = torch.zeros((state_batch.shape[0], state_batch.shape[1])).to(self.device)
             fD_x[:, 1::2] = sigma_pred_batch[:, 1::2, 0].squeeze(-1)
 
-            # g(x)
-            g_x = torch.zeros((state_batch.shape[0], state_batch.shape[1], 1)).to(self.device)
-            g_x[:, 7, 0] = 50.0  # Car 4's acceleration
-
             # h1
             h13 = 0.5 * (((pos[:, 2] - pos[:, 3]) ** 2) - collision_radius ** 2)
             h15 = 0.5 * (((pos[:, 4] - pos[:, 3]) ** 2) - collision_radius ** 2)
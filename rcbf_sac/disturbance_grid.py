@@ -0,0 +1,99 @@
+import itertools
+import numpy as np
+import torch
+
+
+class DisturbanceGrid:
+    """Lookup table of the disturbance model's mean and std on a regular grid over a low-dimensional state space,
+    queried by multilinear (e.g. trilinear for Unicycle's (x, y, theta)) interpolation of the 2^n_dims surrounding grid
+    points.
+
+    Non-periodic dimensions have grid points at np.linspace(lower, upper, n) and queries outside of [lower, upper] are
+    clamped to the bounds. Periodic dimensions (angles) have n points over [lower, upper) and wrap around.
+    """
+
+    def __init__(self, lower, upper, n_points, periodic):
+        """
+        Parameters
+        ----------
+        lower, upper : array_like
+            Bounds of each dimension, shape (n_dims,)
+        n_points : int or array_like
+            Number of grid points along each dimension.
+        periodic : array_like
+            Whether each dimension wraps around (upper is then identified with lower).
+        """
+
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.n_dims = self.lower.shape[0]
+        self.n_points = np.broadcast_to(n_points, (self.n_dims,)).astype(np.int64)
+        self.periodic = np.asarray(periodic, dtype=bool)
+        # Distance between grid points along each dimension
+        self.spacing = (self.upper - self.lower) / np.where(self.periodic, self.n_points, self.n_points - 1)
+        self.mean = None  # shape (*n_points, n_s)
+        self.std = None
+        self.tensors = dict()  # (device, dtype) -> the grid's arrays as tensors
+
+    def points(self):
+        """Returns the grid points, shape (prod(n_points), n_dims), in the same order as the flattened tables."""
+
+        axes = [self.lower[k] + self.spacing[k] * np.arange(self.n_points[k]) for k in range(self.n_dims)]
+        return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, self.n_dims)
+
+    def fit(self, predict_fn, chunk_size=4096):
+        """Fills the tables by evaluating predict_fn (ndarray (n, n_dims) -> (means, stds)) on the grid points."""
+
+        points = self.points()
+        means, stds = [], []
+        for start in range(0, points.shape[0], chunk_size):
+            mean, std = predict_fn(points[start:start + chunk_size])
+            means.append(mean)
+            stds.append(std)
+        self.mean = np.concatenate(means).reshape(tuple(self.n_points) + (-1,))
+        self.std = np.concatenate(stds).reshape(tuple(self.n_points) + (-1,))
+        self.tensors = dict()
+
+    def lookup(self, x):
+        """Interpolates the mean and std at x of shape (n, n_dims), ndarray or tensor (kept on its device and dtype)."""
+
+        if torch.is_tensor(x):
+            key = (x.device, x.dtype)
+            if key not in self.tensors:
+                self.tensors[key] = tuple(torch.as_tensor(a, device=x.device, dtype=x.dtype) for a in (self.lower, self.spacing, self.mean, self.std)) + \
+                                    (torch.as_tensor(self.n_points, device=x.device), torch.as_tensor(self.periodic, device=x.device))
+            lower, spacing, mean, std, n_points, periodic = self.tensors[key]
+            pos = (x - lower) / spacing
+            pos = torch.where(periodic, pos, pos.clamp(min=torch.zeros_like(pos), max=(n_points - 1).to(x.dtype)))
+            idx0 = pos.floor().long()
+            # The last point of a non-periodic dimension is interpolated from the cell before it
+            idx0 = torch.where(periodic, idx0, torch.minimum(idx0, n_points - 2))
+            frac = pos - idx0.to(x.dtype)
+            idx1 = torch.where(periodic, (idx0 + 1) % n_points, idx0 + 1)
+            idx0 = torch.where(periodic, idx0 % n_points, idx0)
+        else:
+            pos = (x - self.lower) / self.spacing
+            pos = np.where(self.periodic, pos, np.clip(pos, 0, self.n_points - 1))
+            idx0 = np.floor(pos).astype(np.int64)
+            idx0 = np.where(self.periodic, idx0, np.minimum(idx0, self.n_points - 2))
+            frac = pos - idx0
+            idx1 = np.where(self.periodic, (idx0 + 1) % self.n_points, idx0 + 1)
+            idx0 = np.where(self.periodic, idx0 % self.n_points, idx0)
+            mean, std = self.mean, self.std
+
+        means, stds = 0, 0
+        for corner in itertools.product((0, 1), repeat=self.n_dims):
+            weight = 1
+            for k, c in enumerate(corner):
+                weight = weight * (frac[:, k] if c else 1 - frac[:, k])
+            idx = tuple(idx1[:, k] if c else idx0[:, k] for k, c in enumerate(corner))
+            means = means + weight[:, None] * mean[idx]
+            stds = stds + weight[:, None] * std[idx]
+        return means, stds
+
+    def max_error(self, predict_fn, test_x):
+        """Returns the max absolute error of the interpolated mean and std against predict_fn at test_x."""
+
+        mean, std = predict_fn(test_x)
+        grid_mean, grid_std = self.lookup(test_x)
+        return np.max(np.abs(grid_mean - mean)), np.max(np.abs(grid_std - std))
@@ -1,6 +1,9 @@
+import os
+import threading
 import numpy as np
 import torch
-from rcbf_sac.gp_model import GPyDisturbanceEstimator
+from rcbf_sac.gp_model import GPyDisturbanceEstimator, BatchedGPyDisturbanceEstimator, SVGPDisturbanceEstimator, RFFDisturbanceEstimator
+from rcbf_sac.disturbance_grid import DisturbanceGrid
 from rcbf_sac.utils import to_tensor, to_numpy
 
 """
@@ -25,6 +28,109 @@ DYNAMICS_MODE = {'Unicycle': {'n_s': 3, 'n_u': 2},   # state = [x y θ]
 MAX_STD = {'Unicycle': [2e-1, 2e-1, 2e-1], 'SimulatedCars': [0, 0.2, 0, 0.2, 0, 0.2, 0, 0.2, 0, 0.2],  'Pvtol': [0, 0, 0, 0, 0, 0]}
 
 
+def _zeros(like, shape):
+    """np.zeros, or a tensor of zeros on the device and with the dtype of like if it's a tensor."""
+    if torch.is_tensor(like):
+        return like.new_zeros(shape)
+    return np.zeros(shape)
+
+
+def get_nominal_dynamics(dynamics_mode):
+    """Returns the nominal (disturbance free) dynamics x' = f(x) + g(x)u of an environment.
+
+    Both functions take a state batch of shape (batch_size, n_s) and an optional time batch, and work on ndarrays or on
+    tensors (computed on the tensor's device and with its dtype).
+
+    Parameters
+    ----------
+    dynamics_mode : str
+        One of DYNAMICS_MODE.
+
+    Returns
+    -------
+    get_f : callable
+            Drift dynamics of the continuous system x' = f(x) + g(x)u
+    get_g : callable
+            Control dynamics of the continuous system x' = f(x) + g(x)u
+    """
+
+    if dynamics_mode == 'Unicycle':
+
+        def get_f(state_batch, t_batch=None):
+            f_x = _zeros(state_batch, state_batch.shape)
+            return f_x
+
+        def get_g(state_batch, t_batch=None):
+            lib = torch if torch.is_tensor(state_batch) else np
+            theta = state_batch[:, 2]
+            g_x = _zeros(state_batch, (state_batch.shape[0], 3, 2))
+            g_x[:, 0, 0] = lib.cos(theta)
+            g_x[:, 1, 0] = lib.sin(theta)
+            g_x[:, 2, 1] = 1.0
+            return g_x
+
+    elif dynamics_mode == 'SimulatedCars':
+
+        kp = 4.0
+        k_brake = 20.0
+
+        def get_g(state_batch, t_batch=None):
+
+            g_x = _zeros(state_batch, (state_batch.shape[0], 10, 1))
+            g_x[:, 7, 0] = 50.0  # Car 4's acceleration
+            return g_x
+
+        def get_f(state_batch, t_batch=None):
+
+            # Current State
+            pos = state_batch[:, ::2]
+            vels = state_batch[:, 1::2]
+
+            # Action (acceleration)
+            vels_des = 30.0 + _zeros(state_batch, (state_batch.shape[0], 5))  # Desired velocities
+            if t_batch is not None:  # the lead car's desired velocity varies with time
+                if torch.is_tensor(state_batch):
+                    vels_des[:, 0] -= 10 * torch.sin(0.2 * torch.as_tensor(t_batch, dtype=state_batch.dtype, device=state_batch.device))
+                else:
+                    vels_des[:, 0] -= 10 * np.sin(0.2 * t_batch)
+            accels = kp * (vels_des - vels)
+            accels[:, 1] -= k_brake * (pos[:, 0] - pos[:, 1]) * ((pos[:, 0] - pos[:, 1]) < 6.0)
+            accels[:, 2] -= k_brake * (pos[:, 1] - pos[:, 2]) * ((pos[:, 1] - pos[:, 2]) < 6.0)
+            accels[:, 3] = 0.0  # Car 4's acceleration is controlled directly
+            accels[:, 4] -= k_brake * (pos[:, 2] - pos[:, 4]) * ((pos[:, 2] - pos[:, 4]) < 13.0)
+
+            # f(x)
+            f_x = _zeros(state_batch, state_batch.shape)
+            f_x[:, ::2] = vels
+            f_x[:, 1::2] = accels
+            return f_x
+
+    elif dynamics_mode == 'Pvtol':
+
+        def get_f(state_batch, t_batch=None):
+            lib = torch if torch.is_tensor(state_batch) else np
+            theta = state_batch[:, 2]
+            f_x = _zeros(state_batch, state_batch.shape)
+            f_x[:, 0] = state_batch[:, 3]  # x_d = v_x
+            f_x[:, 1] = state_batch[:, 4]  # y_d = v_y
+            f_x[:, 2] = 0  # theta_d = omega = u_2
+            f_x[:, 3] = -lib.sin(theta) * state_batch[:, 5]  # v_x_d = ...
+            f_x[:, 4] = lib.cos(theta) * state_batch[:, 5] - 1  # v_y_d = ...
+            f_x[:, 5] = 0  # thrust_d = u1
+            return f_x
+
+        def get_g(state_batch, t_batch=None):
+            g_x = _zeros(state_batch, (state_batch.shape[0], state_batch.shape[1], 2))
+            g_x[:, 2, 1] = 1.0
+            g_x[:, 5, 0] = 1.0
+            return g_x
+
+    else:
+        raise Exception('Unknown Dynamics mode.')
+
+    return get_f, get_g
+
+
 class DynamicsModel:
 
     def __init__(self, env, args):
@@ -45,12 +151,53 @@ class DynamicsModel:
         # Keep Disturbance History to estimate it using GPs
         self.disturb_estimators = None
         self.disturbance_history = dict()
-        self.history_counter = 0  # keeping only max_history_count points in the buffer
+        self.history_counter = 0  # number of points appended so far, the GPs are refit every max_history_count / 10
         self.max_history_count = args.gp_model_size  # How many points we want to have in the GP
         self.disturbance_history['state'] = np.zeros((self.max_history_count, self.n_s))
         self.disturbance_history['disturbance'] = np.zeros((self.max_history_count, self.n_s))
+        self.history_size = 0  # number of points in the buffer
+        self.history_position = 0  # next slot of the ring buffer to write
+        # Coverage-aware history: keep only the latest point of each voxel of edge gp_history_voxel in GP input units
+        # (states divided by the x_std of the last fit), so that idling or repeating a path doesn't fill the buffer with
+        # near-duplicate states. 0 keeps a plain FIFO ring. Points are only deduplicated once the GPs were fit once.
+        self.gp_history_voxel = getattr(args, 'gp_history_voxel', 0.)
+        self.voxel_slots = dict()  # voxel key -> buffer slot of its point
+        self.slot_voxels = [None] * self.max_history_count  # voxel key of each buffer slot
+        self.voxel_generation = None  # gp_generation whose x_std the voxel keys were computed with
+        self.history_duplicates = 0  # appended points that replaced the point of their voxel
         self.train_x = None  # x-data used to fit the last GP models
         self.train_y = None  # y-data used to fit the last GP models
+        self.gp_norm = None  # normalization stats of the last fit, see _normalization_stats
+        self.gp_generation = 0  # number of times the GP models were fit
+        # Fit all dimensions as one batched GP instead of one GP per dimension (faster on GPU, not on a single core)
+        self.gp_batched = getattr(args, 'gp_batched', False)
+        # Dimensions with no expected disturbance (zero prior std) always predict zero and don't get a GP
+        self.gp_dims = np.flatnonzero(MAX_STD[self.env.dynamics_mode])
+        # Condition the GPs on new points as they're appended, in between the hyperparameter refits
+        self.gp_incremental = getattr(args, 'gp_incremental', False)
+        self.gp_posterior_updates = 0  # incremental updates folded into the cached posteriors
+        self.gp_posterior_resets = 0  # incremental updates that had to reset the GPs' data to the history instead
+        # Start each refit from the previous hyperparameters, and stop training once the loss changes by less than gp_tol
+        self.gp_warm_start = getattr(args, 'gp_warm_start', False)
+        self.gp_tol = getattr(args, 'gp_tol', None)
+        self.gp_fit_iters = None  # training iterations used by each GP in the last fit
+        # 'exact' GPs, sparse variational GPs ('svgp') trained on minibatches for large gp_model_size, or random Fourier
+        # feature regression ('rff') whose prediction cost doesn't depend on the number of points
+        self.gp_backend = getattr(args, 'gp_backend', 'exact')
+        self.gp_num_inducing = getattr(args, 'gp_num_inducing', 256)
+        self.gp_num_features = getattr(args, 'gp_num_features', 256)
+        # Refit the GPs in a background thread on a snapshot of the history, the old GPs are used until it's done
+        self.gp_async = getattr(args, 'gp_async', False)
+        self.gp_lock = threading.Lock()  # held while swapping in newly fit GPs
+        self.fit_thread = None
+        self.fit_error = None  # exception raised in the background fit, re-raised on the next fit_gp_model
+        self.gp_skipped_fits = 0  # refits skipped because the previous background fit was still running
+        # Serve predict_disturbance from a lookup table of the GPs on a grid of gp_grid_size^3 states, rebuilt every fit
+        self.gp_grid_size = getattr(args, 'gp_grid_size', 0)
+        self.gp_grid = None
+        self.gp_grid_error = None  # max abs error of the grid's (mean, std) against the GPs at random states
+        if self.gp_grid_size and self.env.dynamics_mode != 'Unicycle':
+            raise Exception('The disturbance grid is only supported for Unicycle.')
 
         # Point Robot specific dynamics (approx using unicycle + look-ahead)
         if hasattr(args, 'l_p'):
@@ -63,11 +210,11 @@ class DynamicsModel:
 
         Parameters
         ----------
-        state_batch : ndarray
+        state_batch : ndarray or torch.tensor
             State
-        u_batch : ndarray
+        u_batch : ndarray or torch.tensor
             Action
-        t_batch: ndarray, optional
+        t_batch: ndarray or torch.tensor, optional
             Time batch for state dependant dynamics
         use_gps : bool, optional
             Use GPs to return mean and var
@@ -78,6 +225,9 @@ class DynamicsModel:
             Next state
         """
 
+        if torch.is_tensor(state_batch):
+            return self._predict_next_state_torch(state_batch, u_batch, t_batch, use_gps)
+
         expand_dims = len(state_batch.shape) == 1
         if expand_dims:
             state_batch = np.expand_dims(state_batch, axis=0)
@@ -105,6 +255,31 @@ class DynamicsModel:
 
         return next_state_batch, self.env.dt * pred_std, t_batch
 
+    def _predict_next_state_torch(self, state_batch, u_batch, t_batch=None, use_gps=True):
+        """Same as predict_next_state for tensors, the whole computation stays on state_batch's device and dtype."""
+
+        expand_dims = len(state_batch.shape) == 1
+        if expand_dims:
+            state_batch = state_batch.unsqueeze(0)
+            u_batch = u_batch.unsqueeze(0)
+        u_batch = torch.as_tensor(u_batch, dtype=state_batch.dtype, device=state_batch.device)
+
+        # Start with our prior for continuous time system x' = f(x) + g(x)u
+        next_state_batch = state_batch + self.env.dt * (self.get_f(state_batch, t_batch) + (self.get_g(state_batch, t_batch) @ u_batch.unsqueeze(-1)).squeeze(-1))
+
+        if use_gps:  # if we want estimate the disturbance, let's do it!
+            pred_mean, pred_std = self._predict_disturbance_torch(state_batch)
+            next_state_batch = next_state_batch + self.env.dt * pred_mean
+        else:
+            pred_std = torch.zeros_like(state_batch)
+
+        if expand_dims:
+            next_state_batch = next_state_batch.squeeze(0)
+            pred_std = pred_std.squeeze(0)
+
+        next_t_batch = t_batch + self.env.dt if t_batch is not None else None
+        return next_state_batch, self.env.dt * pred_std, next_t_batch
+
     def predict_next_obs(self, state, u):
         """Predicts the next observation given the state and u. Note that this only predicts the mean next observation.
 
@@ -137,75 +312,7 @@ class DynamicsModel:
                 Control dynamics of the continuous system x' = f(x) + g(x)u
         """
 
-        if self.env.dynamics_mode == 'Unicycle':
-
-            def get_f(state_batch, t_batch=None):
-                f_x = np.zeros(state_batch.shape)
-                return f_x
-
-            def get_g(state_batch, t_batch=None):
-                theta = state_batch[:, 2]
-                g_x = np.zeros((state_batch.shape[0], 3, 2))
-                g_x[:, 0, 0] = np.cos(theta)
-                g_x[:, 1, 0] = np.sin(theta)
-                g_x[:, 2, 1] = 1.0
-                return g_x
-
-        elif self.env.dynamics_mode == 'SimulatedCars':
-
-            kp = 4.0
-            k_brake = 20.0
-
-            def get_g(state_batch, t_batch):
-
-                g_x = np.zeros((state_batch.shape[0], 10, 1))
-                g_x[:, 7, 0] = 50.0  # Car 4's acceleration
-                return g_x
-
-            def get_f(state_batch, t_batch):
-
-                # Current State
-                pos = state_batch[:, ::2]
-                vels = state_batch[:, 1::2]
-
-                # Action (acceleration)
-                vels_des = 30.0 * np.ones((state_batch.shape[0], 5))  # Desired velocities
-                vels_des[:, 0] -= 10 * np.sin(0.2 * t_batch)
-                accels = kp * (vels_des - vels)
-                accels[:, 1] -= k_brake * (pos[:, 0] - pos[:, 1]) * ((pos[:, 0] - pos[:, 1]) < 6.0)
-                accels[:, 2] -= k_brake * (pos[:, 1] - pos[:, 2]) * ((pos[:, 1] - pos[:, 2]) < 6.0)
-                accels[:, 3] = 0.0  # Car 4's acceleration is controlled directly
-                accels[:, 4] -= k_brake * (pos[:, 2] - pos[:, 4]) * ((pos[:, 2] - pos[:, 4]) < 13.0)
-
-                # f(x)
-                f_x = np.zeros(state_batch.shape)
-                f_x[:, ::2] = vels
-                f_x[:, 1::2] = accels
-                return f_x
-
-        elif self.env.dynamics_mode == 'Pvtol':
-
-            def get_f(state_batch, t_batch=None):
-                theta = state_batch[:, 2]
-                f_x = np.zeros(state_batch.shape)
-                f_x[:, 0] = state_batch[:, 3]  # x_d = v_x
-                f_x[:, 1] = state_batch[:, 4]  # y_d = v_y
-                f_x[:, 2] = 0  # theta_d = omega = u_2
-                f_x[:, 3] = -np.sin(theta) * state_batch[:, 5]  # v_x_d = ...
-                f_x[:, 4] = np.cos(theta) * state_batch[:, 5] - 1  # v_y_d = ...
-                f_x[:, 5] = 0  # thrust_d = u1
-                return f_x
-
-            def get_g(state_batch, t_batch=None):
-                g_x = np.zeros((state_batch.shape[0], state_batch.shape[1], 2))
-                g_x[:, 2, 1] = 1.0
-                g_x[:, 5, 0] = 1.0
-                return g_x
-
-        else:
-            raise Exception('Unknown Dynamics mode.')
-
-        return get_f, get_g
+        return get_nominal_dynamics(self.env.dynamics_mode)
 
     def get_state(self, obs):
         """Given the observation, this function does the pre-processing necessary and returns the state.
@@ -222,13 +329,10 @@ class DynamicsModel:
 
         """
 
-        expand_dims = len(obs.shape) == 1
-        is_tensor = torch.is_tensor(obs)
+        if torch.is_tensor(obs):
+            return self._get_state_torch(obs)
 
-        if is_tensor:
-            dtype = obs.dtype
-            device = obs.device
-            obs = to_numpy(obs)
+        expand_dims = len(obs.shape) == 1
 
         if expand_dims:
             obs = np.expand_dims(obs, 0)
@@ -258,23 +362,49 @@ class DynamicsModel:
         if expand_dims:
             state_batch = state_batch.squeeze(0)
 
-        return to_tensor(state_batch, dtype, device) if is_tensor else state_batch
+        return state_batch
+
+    def _get_state_torch(self, obs):
+        """Same as get_state for tensors, keeps the device and dtype of obs."""
+
+        expand_dims = len(obs.shape) == 1
+        if expand_dims:
+            obs = obs.unsqueeze(0)
+
+        if self.env.dynamics_mode == 'Unicycle':
+            state_batch = torch.stack((obs[:, 0], obs[:, 1], torch.atan2(obs[:, 3], obs[:, 2])), dim=1)
+        elif self.env.dynamics_mode == 'SimulatedCars':
+            state_batch = obs.clone()
+            state_batch[:, ::2] *= 100.0  # Scale Positions
+            state_batch[:, 1::2] *= 30.0  # Scale Velocities
+        elif self.env.dynamics_mode == 'Pvtol':
+            state_batch = torch.stack((obs[:, 0], obs[:, 1], torch.atan2(obs[:, 3], obs[:, 2]), obs[:, 4], obs[:, 5], obs[:, 6]), dim=1)
+        else:
+            raise Exception('Unknown dynamics')
+
+        if expand_dims:
+            state_batch = state_batch.squeeze(0)
+
+        return state_batch
 
     def get_obs(self, state_batch):
         """Given the state, this function returns it to an observation akin to the one obtained by calling env.step
 
         Parameters
         ----------
-        state : ndarray
+        state : ndarray or torch.tensor
             Environment state batch of shape (batch_size, n_s)
 
         Returns
         -------
-        obs : ndarray
+        obs : ndarray or torch.tensor
           Observation batch of shape (batch_size, n_o)
 
         """
 
+        if torch.is_tensor(state_batch):
+            return self._get_obs_torch(state_batch)
+
         if self.env.dynamics_mode == 'Unicycle':
             obs = np.zeros((state_batch.shape[0], 4))
             obs[:, 0] = state_batch[:, 0]
@@ -285,15 +415,31 @@ class DynamicsModel:
             obs = np.copy(state_batch)
             obs[:, ::2] /= 100.0  # Scale Positions
             obs[:, 1::2] /= 30.0  # Scale Velocities
-        elif self.env.dynamics_mode == 'PVTOL':
+        elif self.env.dynamics_mode == 'Pvtol':
             obs = np.zeros((state_batch.shape[0], 7))
             obs[:, 0] = state_batch[:, 0]
             obs[:, 1] = state_batch[:, 1]
             obs[:, 2] = np.cos(state_batch[:, 2])
             obs[:, 3] = np.sin(state_batch[:, 2])
-            obs[:, 4] = state_batch[:, 4]
-            obs[:, 5] = state_batch[:, 5]
-            obs[:, 6] = state_batch[:, 6]
+            obs[:, 4] = state_batch[:, 3]
+            obs[:, 5] = state_batch[:, 4]
+            obs[:, 6] = state_batch[:, 5]
+        else:
+            raise Exception('Unknown dynamics')
+        return obs
+
+    def _get_obs_torch(self, state_batch):
+        """Same as get_obs for tensors, keeps the device and dtype of state_batch."""
+
+        if self.env.dynamics_mode == 'Unicycle':
+            obs = torch.stack((state_batch[:, 0], state_batch[:, 1], torch.cos(state_batch[:, 2]), torch.sin(state_batch[:, 2])), dim=1)
+        elif self.env.dynamics_mode == 'SimulatedCars':
+            obs = state_batch.clone()
+            obs[:, ::2] /= 100.0  # Scale Positions
+            obs[:, 1::2] /= 30.0  # Scale Velocities
+        elif self.env.dynamics_mode == 'Pvtol':
+            obs = torch.stack((state_batch[:, 0], state_batch[:, 1], torch.cos(state_batch[:, 2]), torch.sin(state_batch[:, 2]),
+                               state_batch[:, 3], state_batch[:, 4], state_batch[:, 5]), dim=1)
         else:
             raise Exception('Unknown dynamics')
         return obs
@@ -314,7 +460,11 @@ class DynamicsModel:
 
         Returns
         -------
-
+        n_refits : int
+            Number of GP refits started by this call, at most one (after all the points are appended).
+        n_skipped_refits : int
+            Number of refits that were due during this call but not started: the ones merged into that single refit,
+            plus the one skipped if a background fit was still running (see gp_async).
         """
 
         expand_dims = len(state_batch.shape) == 1
@@ -329,17 +479,102 @@ class DynamicsModel:
         disturbance_batch = (next_state_batch - state_batch - self.env.dt * (self.get_f(state_batch, t_batch) + (self.get_g(state_batch, t_batch) @ u_batch).squeeze(-1))) / self.env.dt
 
         # Append new data point (state, disturbance) to our dataset
-        for i in range(state_batch.shape[0]):
+        voxel_size = self._voxel_size()
+        if voxel_size is None:
+            self._write_ring(state_batch, disturbance_batch)
+        else:
+            for i in range(state_batch.shape[0]):
+                slot = self._history_slot(state_batch[i], voxel_size)
+                self.disturbance_history['state'][slot] = state_batch[i]
+                self.disturbance_history['disturbance'][slot] = disturbance_batch[i]
+
+        # Update GP models every max_history_count / 10 data points, once for all the ones due during this batch
+        counts = self.history_counter + np.arange(1, state_batch.shape[0] + 1)
+        n_due = np.count_nonzero(counts % (self.max_history_count / 10) == 0)
+        self.history_counter += state_batch.shape[0]
+
+        n_refits = 0
+        if n_due > 0:
+            gp_skipped_fits = self.gp_skipped_fits
+            self.fit_gp_model()
+            n_refits = 1 - (self.gp_skipped_fits - gp_skipped_fits)
+
+        # Unless a refit on them was started, fold the new points into the current GPs
+        if n_refits == 0 and self.gp_incremental and self.disturb_estimators:
+            self.update_gp_posterior(state_batch, disturbance_batch)
+        return n_refits, n_due - n_refits
+
+    def _write_ring(self, state_batch, disturbance_batch):
+        """Writes a batch of points to the next slots of the ring buffer with (at most two) slice writes. Only the last
+        max_history_count points are kept if there are more."""
+
+        state_batch = state_batch[-self.max_history_count:]
+        disturbance_batch = disturbance_batch[-self.max_history_count:]
+        n = state_batch.shape[0]
+        start = self.history_position
+        n_first = min(n, self.max_history_count - start)  # up to the end of the buffer, the rest wraps around
+        for key, values in (('state', state_batch), ('disturbance', disturbance_batch)):
+            self.disturbance_history[key][start:start + n_first] = values[:n_first]
+            self.disturbance_history[key][:n - n_first] = values[n_first:]
+        self.history_position = (start + n) % self.max_history_count
+        self.history_size = min(self.history_size + n, self.max_history_count)
+
+    def _voxel_size(self):
+        """Returns the voxel edge lengths in state units (None if the history isn't deduplicated yet), recomputing the
+        voxel keys of the buffer whenever the GPs were refit with new normalization stats."""
+
+        if not self.gp_history_voxel:
+            return None
+        with self.gp_lock:
+            gp_norm, gp_generation = self.gp_norm, self.gp_generation
+        if gp_norm is None:
+            return None
+        voxel_size = self.gp_history_voxel * gp_norm['x_std']
+        if self.voxel_generation != gp_generation:
+            self.voxel_slots = dict()
+            self.slot_voxels = [None] * self.max_history_count
+            # From the oldest to the newest slot, so that the map points to the latest point of each voxel
+            for slot in (self.history_position - self.history_size + np.arange(self.history_size)) % self.max_history_count:
+                key = np.floor(self.disturbance_history['state'][slot] / voxel_size).astype(np.int64).tobytes()
+                self.slot_voxels[slot] = key
+                self.voxel_slots[key] = slot
+            self.voxel_generation = gp_generation
+        return voxel_size
+
+    def _history_slot(self, state, voxel_size=None):
+        """Returns the buffer slot to write a new point at: the slot of the point in the same voxel if there is one,
+        otherwise the next slot of the ring (evicting the point there).
 
-            self.disturbance_history['state'][self.history_counter % self.max_history_count] = state_batch[i]
-            self.disturbance_history['disturbance'][self.history_counter % self.max_history_count] = disturbance_batch[i]
+        Parameters
+        ----------
+        state : ndarray
+            shape (n_s,)
+        voxel_size : ndarray, optional
+            shape (n_s,), see _voxel_size. None writes to the next slot of the ring.
 
-            # Increment how many data points we have
-            self.history_counter += 1
+        Returns
+        -------
+        slot : int
+        """
 
-            # Update GP models every max_history_count data points
-            if self.history_counter % (self.max_history_count/10) == 0:
-                self.fit_gp_model()
+        key = None
+        if voxel_size is not None:
+            key = np.floor(state / voxel_size).astype(np.int64).tobytes()
+            slot = self.voxel_slots.get(key)
+            if slot is not None:
+                self.history_duplicates += 1
+                return slot
+
+        slot = self.history_position
+        old_key = self.slot_voxels[slot]
+        if old_key is not None and self.voxel_slots.get(old_key) == slot:
+            del self.voxel_slots[old_key]
+        self.slot_voxels[slot] = key
+        if key is not None:
+            self.voxel_slots[key] = slot
+        self.history_position = (slot + 1) % self.max_history_count
+        self.history_size = min(self.history_size + 1, self.max_history_count)
+        return slot
 
     def fit_gp_model(self, training_iter=70):
         """
@@ -347,35 +582,173 @@ class DynamicsModel:
         Parameters
         ----------
         training_iter : int
-            Number of training iterations for GP model.
+            Maximum number of training iterations for GP model.
 
         Returns
         -------
-
+        gp_fit_iters : list or None
+            Number of training iterations used by each GP model (a single one in batched mode). None in async mode, where
+            the GPs are only swapped in once the background fit is done (see gp_generation and gp_fit_iters).
         """
 
-        if self.history_counter < self.max_history_count:  # didn't fill the buffer yet
-            train_x = self.disturbance_history['state'][:self.history_counter]
-            train_y = self.disturbance_history['disturbance'][:self.history_counter]
-        else:  # buffer filled, use all the data points
-            train_x = self.disturbance_history['state']
-            train_y = self.disturbance_history['disturbance']
+        if self.fit_error is not None:
+            error, self.fit_error = self.fit_error, None
+            raise error
+
+        # Snapshot the data, the history buffer keeps being written to
+        train_x, train_y = self._get_history()
+        train_x = train_x.copy()
+        train_y = train_y.copy()
+
+        if not self.gp_async:
+            return self._fit_and_swap(train_x, train_y, training_iter)
+
+        if self.fit_thread is not None and self.fit_thread.is_alive():
+            self.gp_skipped_fits += 1
+            return None
+        self.fit_thread = threading.Thread(target=self._fit_worker, args=(train_x, train_y, training_iter), daemon=True)
+        self.fit_thread.start()
+        return None
+
+    def wait_for_fit(self):
+        """Blocks until the background GP fit (if any) is done."""
+
+        if self.fit_thread is not None:
+            self.fit_thread.join()
+            self.fit_thread = None
+
+    def _fit_worker(self, train_x, train_y, training_iter):
+        try:
+            self._fit_and_swap(train_x, train_y, training_iter)
+        except Exception as e:  # Surface it in the training thread
+            self.fit_error = e
+
+    def _fit_and_swap(self, train_x, train_y, training_iter):
+        """Fits new GPs to the data then replaces the current ones with them."""
 
         # Normalize Data
-        train_x_std = np.std(train_x, axis=0)
-        train_x_normalized = train_x / (train_x_std + 1e-8)
-        train_y_std = np.std(train_y, axis=0)
-        train_y_normalized = train_y / (train_y_std + 1e-8)
+        gp_norm = self._normalization_stats(train_x, train_y)
+        train_x_normalized = train_x / gp_norm['x_std']
+        train_y_normalized = train_y / gp_norm['y_std']
+
+        # Only fit the dimensions in gp_dims, disturb_estimators[j] is the GP of dimension gp_dims[j]
+        prior_std = np.array(MAX_STD[self.env.dynamics_mode])[self.gp_dims]
+        prev_estimators = self.disturb_estimators if self.gp_warm_start else None
+        if self.gp_batched and self.gp_dims.shape[0] > 0:
+            disturb_estimators = BatchedGPyDisturbanceEstimator(train_x_normalized, train_y_normalized[:, self.gp_dims], prior_std, device=self.device)
+            if isinstance(prev_estimators, BatchedGPyDisturbanceEstimator):
+                disturb_estimators.warm_start(prev_estimators)
+            gp_fit_iters = [disturb_estimators.train(training_iter, tol=self.gp_tol)]
+        else:
+            disturb_estimators = []
+            gp_fit_iters = []
+            for j, i in enumerate(self.gp_dims):
+                # disturb_estimators.append(GPyDisturbanceEstimator(train_x, train_y[:, i]))
+                disturb_estimators.append(self._make_estimator(train_x_normalized, train_y_normalized[:, i], prior_std[j]))
+                if isinstance(prev_estimators, list) and len(prev_estimators) == len(self.gp_dims):
+                    disturb_estimators[j].warm_start(prev_estimators[j])
+                gp_fit_iters.append(disturb_estimators[j].train(training_iter, tol=self.gp_tol))
+
+        gp_grid, gp_grid_error = self._build_grid(disturb_estimators, gp_norm) if self.gp_grid_size else (None, None)
+
+        with self.gp_lock:
+            self.disturb_estimators = disturb_estimators
+            # track the data I last used to fit the GPs for saving purposes (need it to initialize before loading weights)
+            self.train_x = train_x
+            self.train_y = train_y
+            self.gp_norm = gp_norm
+            self.gp_grid = gp_grid
+            self.gp_grid_error = gp_grid_error
+            self.gp_fit_iters = gp_fit_iters
+            self.gp_generation += 1
+        return gp_fit_iters
+
+    def _build_grid(self, disturb_estimators, gp_norm, n_test=1000):
+        """Tabulates the GPs over (x, y, theta) in env.bds x [-pi, pi) and measures the interpolation error."""
+
+        bds = self.env.bds
+        gp_grid = DisturbanceGrid([bds[0, 0], bds[0, 1], -np.pi], [bds[1, 0], bds[1, 1], np.pi], self.gp_grid_size, periodic=[False, False, True])
+        predict_fn = lambda x: self._predict_gp(disturb_estimators, gp_norm, x)
+        gp_grid.fit(predict_fn)
+        test_x = np.random.default_rng(self.gp_generation).uniform(gp_grid.lower, gp_grid.upper, size=(n_test, gp_grid.n_dims))
+        return gp_grid, gp_grid.max_error(predict_fn, test_x)
+
+    def update_gp_posterior(self, state_batch, disturbance_batch):
+        """Conditions the current GPs on new (state, disturbance) points without retraining their hyperparameters.
+
+        The GPs are refit on the current history every max_history_count / 10 appended points, so in between they're
+        allowed to hold up to that many points on top of max_history_count, and new points are folded into the cached
+        posteriors with a low-rank update. Only if they'd grow past that (e.g. a refit was skipped in async mode) are the
+        oldest points evicted by resetting the GPs' data to the current history, which costs one Cholesky factorization
+        at the next prediction instead of a full refit.
 
-        self.disturb_estimators = []
-        for i in range(self.n_s):
-            # self.disturb_estimators.append(GPyDisturbanceEstimator(train_x, train_y[:, i]))
-            self.disturb_estimators.append(GPyDisturbanceEstimator(train_x_normalized, train_y_normalized[:, i], MAX_STD[self.env.dynamics_mode][i], device=self.device))
-            self.disturb_estimators[i].train(training_iter)
+        Parameters
+        ----------
+        state_batch : ndarray
+            shape (k, n_s)
+        disturbance_batch : ndarray
+            shape (k, n_s)
+        """
 
-        # track the data I last used to fit the GPs for saving purposes (need it to initialize before loading weights)
-        self.train_x = train_x
-        self.train_y = train_y
+        disturb_estimators, gp_norm, _ = self._gp_snapshot()
+
+        # Same normalization as the last fit
+        train_x_std = gp_norm['x_std']
+        train_y_std = gp_norm['y_std']
+        batched = isinstance(disturb_estimators, BatchedGPyDisturbanceEstimator)
+        n_points = (disturb_estimators if batched else disturb_estimators[0]).train_y.shape[-1]
+
+        max_points = self.max_history_count + int(np.ceil(self.max_history_count / 10))
+        if n_points + state_batch.shape[0] <= max_points:
+            self.gp_posterior_updates += 1
+            new_x = state_batch / train_x_std
+            new_y = disturbance_batch / train_y_std
+            if batched:
+                disturb_estimators.update_posterior(new_x, new_y[:, self.gp_dims])
+            else:
+                for j, i in enumerate(self.gp_dims):
+                    disturb_estimators[j].update_posterior(new_x, new_y[:, i])
+        else:
+            self.gp_posterior_resets += 1
+            train_x, train_y = self._get_history()
+            train_x = train_x / train_x_std
+            train_y = train_y / train_y_std
+            if batched:
+                disturb_estimators.set_train_data(train_x, train_y[:, self.gp_dims])
+            else:
+                for j, i in enumerate(self.gp_dims):
+                    disturb_estimators[j].set_train_data(train_x, train_y[:, i])
+
+    def _gp_snapshot(self):
+        """Returns the current GPs, the normalization stats they were fit with and their lookup table (consistent even if
+        a background fit swaps them at the same time)."""
+
+        with self.gp_lock:
+            return self.disturb_estimators, self.gp_norm, self.gp_grid
+
+    @staticmethod
+    def _normalization_stats(train_x, train_y):
+        """Scales that the GP inputs and targets are divided by, computed once per fit. The 'torch' entry caches them as
+        tensors for each (device, dtype) they're used with."""
+
+        return {'x_std': np.std(train_x, axis=0) + 1e-8, 'y_std': np.std(train_y, axis=0) + 1e-8, 'torch': dict()}
+
+    def _make_estimator(self, train_x, train_y, prior_std):
+        """Builds the GP of a single state dimension with the selected backend."""
+
+        if self.gp_backend == 'svgp':
+            return SVGPDisturbanceEstimator(train_x, train_y, prior_std, device=self.device, num_inducing=self.gp_num_inducing)
+        if self.gp_backend == 'rff':
+            return RFFDisturbanceEstimator(train_x, train_y, prior_std, device=self.device, num_features=self.gp_num_features)
+        return GPyDisturbanceEstimator(train_x, train_y, prior_std, device=self.device)
+
+    def _get_history(self):
+        """Returns the (state, disturbance) points currently in the history buffer."""
+
+        if self.history_size < self.max_history_count:  # didn't fill the buffer yet
+            return self.disturbance_history['state'][:self.history_size], self.disturbance_history['disturbance'][:self.history_size]
+        # buffer filled, use all the data points
+        return self.disturbance_history['state'], self.disturbance_history['disturbance']
 
     def predict_disturbance(self, test_x):
         """Predict the disturbance at the queried states using the GP models.
@@ -392,66 +765,144 @@ class DynamicsModel:
             Prediction variances -- shape(n_test, n_s)
         """
 
-        is_tensor = torch.is_tensor(test_x)
-
-        if is_tensor:
-            dtype = test_x.dtype
-            device = test_x.device
-            test_x = to_numpy(test_x)
+        if torch.is_tensor(test_x):
+            return self._predict_disturbance_torch(test_x)
 
         expand_dims = len(test_x.shape) == 1
         if expand_dims:
             test_x = np.expand_dims(test_x, axis=0)
 
+        disturb_estimators, gp_norm, gp_grid = self._gp_snapshot()
+
+        if gp_grid is not None:
+            means, f_std = gp_grid.lookup(test_x)
+        elif disturb_estimators:
+            means, f_std = self._predict_gp(disturb_estimators, gp_norm, test_x)
+        else:  # zero-mean, max_sigma prior
+            means = np.zeros(test_x.shape)
+            f_std = np.ones(test_x.shape)
+            for i in range(self.n_s):
+                f_std[:, i] *= MAX_STD[self.env.dynamics_mode][i]
+
+        if expand_dims:
+            means = means.squeeze(0)
+            f_std = f_std.squeeze(0)
+
+        return means, f_std
+
+    def _predict_gp(self, disturb_estimators, gp_norm, test_x):
+        """Predicts the disturbance at test_x of shape (n_test, n_s) with the given GPs."""
+
         means = np.zeros(test_x.shape)
         f_std = np.zeros(test_x.shape)  # standard deviation
 
-        if self.disturb_estimators:
-            # Normalize
-            train_x_std = np.std(self.train_x, axis=0)
-            train_y_std = np.std(self.train_y, axis=0)
+        # Normalize
+        train_y_std = gp_norm['y_std']
+        test_x = test_x / gp_norm['x_std']
+        if isinstance(disturb_estimators, BatchedGPyDisturbanceEstimator):
+            prediction_ = disturb_estimators.predict(test_x, full_cov=False)
+            means[:, self.gp_dims] = prediction_['mean'] * train_y_std[self.gp_dims]
+            f_std[:, self.gp_dims] = np.sqrt(prediction_['f_var']) * train_y_std[self.gp_dims]
+        else:
+            for j, i in enumerate(self.gp_dims):
+                prediction_ = disturb_estimators[j].predict(test_x, full_cov=False)
+                means[:, i] = prediction_['mean'] * train_y_std[i]
+                f_std[:, i] = np.sqrt(prediction_['f_var']) * train_y_std[i]
+
+        return means, f_std
+
+    def _predict_disturbance_torch(self, test_x):
+        """Same as predict_disturbance for tensors, the whole computation stays on test_x's device and dtype."""
+
+        expand_dims = len(test_x.shape) == 1
+        if expand_dims:
+            test_x = test_x.unsqueeze(0)
+
+        means = torch.zeros_like(test_x)
+        f_std = torch.zeros_like(test_x)  # standard deviation
+
+        disturb_estimators, gp_norm, gp_grid = self._gp_snapshot()
+
+        if gp_grid is not None:
+            means, f_std = gp_grid.lookup(test_x)
+        elif disturb_estimators:
+            # Normalize, with the stats cached on test_x's device
+            key = (test_x.device, test_x.dtype)
+            if key not in gp_norm['torch']:
+                gp_norm['torch'][key] = (torch.as_tensor(gp_norm['x_std'], dtype=test_x.dtype, device=test_x.device),
+                                         torch.as_tensor(gp_norm['y_std'], dtype=test_x.dtype, device=test_x.device),
+                                         torch.as_tensor(self.gp_dims, device=test_x.device))
+            train_x_std, train_y_std, gp_dims = gp_norm['torch'][key]
             test_x = test_x / train_x_std
-            for i in range(self.n_s):
-                prediction_ = self.disturb_estimators[i].predict(test_x)
-                means[:, i] = prediction_['mean'] * (train_y_std[i] + 1e-8)
-                f_std[:, i] = np.sqrt(prediction_['f_var']) * (train_y_std[i] + 1e-8)
+            if isinstance(disturb_estimators, BatchedGPyDisturbanceEstimator):
+                prediction_ = disturb_estimators.predict(test_x, full_cov=False)
+                means[:, gp_dims] = prediction_['mean'].to(test_x) * train_y_std[gp_dims]
+                f_std[:, gp_dims] = torch.sqrt(prediction_['f_var']).to(test_x) * train_y_std[gp_dims]
+            else:
+                for j, i in enumerate(self.gp_dims):
+                    prediction_ = disturb_estimators[j].predict(test_x, full_cov=False)
+                    means[:, i] = prediction_['mean'].to(test_x) * train_y_std[i]
+                    f_std[:, i] = torch.sqrt(prediction_['f_var']).to(test_x) * train_y_std[i]
 
         else:  # zero-mean, max_sigma prior
-            f_std = np.ones(test_x.shape)
-            for i in range(self.n_s):
-                f_std[:, i] *= MAX_STD[self.env.dynamics_mode][i]
+            f_std[:] = torch.as_tensor(MAX_STD[self.env.dynamics_mode], dtype=test_x.dtype, device=test_x.device)
 
         if expand_dims:
             means = means.squeeze(0)
             f_std = f_std.squeeze(0)
 
-        return (to_tensor(means, dtype, device), to_tensor(f_std, dtype, device)) if is_tensor else (means, f_std)
+        return means, f_std
 
     def load_disturbance_models(self, output):
 
         if output is None:
             return
 
-        self.disturb_estimators = []
-
         weights = torch.load('{}/gp_models.pkl'.format(output), map_location=self.device)
         self.train_x = torch.load('{}/gp_models_train_x.pkl'.format(output))
         self.train_y = torch.load('{}/gp_models_train_y.pkl'.format(output))
-        for i in range(self.n_s):
-            self.disturb_estimators.append(GPyDisturbanceEstimator(self.train_x, self.train_y[:, i], MAX_STD[self.env.dynamics_mode][i], device=self.device))
-            self.disturb_estimators[i].model.load_state_dict(weights[i])
+        self.gp_norm = self._normalization_stats(self.train_x, self.train_y)
+        if os.path.exists('{}/gp_models_norm.pkl'.format(output)):
+            norm = torch.load('{}/gp_models_norm.pkl'.format(output))
+            self.gp_norm['x_std'] = norm['x_std'].numpy()
+            self.gp_norm['y_std'] = norm['y_std'].numpy()
+        # The GPs were fit on normalized data
+        train_x = self.train_x / self.gp_norm['x_std']
+        train_y = self.train_y / self.gp_norm['y_std']
+        if isinstance(weights, list) and len(weights) == self.n_s:  # saved with a GP for every dimension
+            weights = [weights[i] for i in self.gp_dims]
+        prior_std = np.array(MAX_STD[self.env.dynamics_mode])[self.gp_dims]
+        if (self.gp_batched or not isinstance(weights, list)) and self.gp_dims.shape[0] > 0:
+            self.disturb_estimators = BatchedGPyDisturbanceEstimator(train_x, train_y[:, self.gp_dims], prior_std, device=self.device)
+            if isinstance(weights, list):  # saved with one GP model per dimension
+                self.disturb_estimators.load_unbatched_state_dicts(weights)
+            else:
+                self.disturb_estimators.model.load_state_dict(weights)
+        else:
+            self.disturb_estimators = []
+            for j, i in enumerate(self.gp_dims):
+                self.disturb_estimators.append(self._make_estimator(train_x, train_y[:, i], prior_std[j]))
+                self.disturb_estimators[j].model.load_state_dict(weights[j])
+        if self.gp_grid_size:
+            self.gp_grid, self.gp_grid_error = self._build_grid(self.disturb_estimators, self.gp_norm)
 
     def save_disturbance_models(self, output):
 
-        if not self.disturb_estimators or self.train_x is None or self.train_y is None:
+        with self.gp_lock:
+            disturb_estimators, train_x, train_y, gp_norm = self.disturb_estimators, self.train_x, self.train_y, self.gp_norm
+        if disturb_estimators is None or train_x is None or train_y is None:
             return
-        weights = []
-        for i in range(len(self.disturb_estimators)):
-            weights.append(self.disturb_estimators[i].model.state_dict())
+        if isinstance(disturb_estimators, BatchedGPyDisturbanceEstimator):
+            weights = disturb_estimators.model.state_dict()
+        else:
+            weights = []
+            for i in range(len(disturb_estimators)):
+                weights.append(disturb_estimators[i].model.state_dict())
         torch.save(weights, '{}/gp_models.pkl'.format(output))
         # Also save data used to fit model (needed for initializing the model before loading weights)
-        torch.save(self.train_x, '{}/gp_models_train_x.pkl'.format(output))
-        torch.save(self.train_y, '{}/gp_models_train_y.pkl'.format(output))
+        torch.save(train_x, '{}/gp_models_train_x.pkl'.format(output))
+        torch.save(train_y, '{}/gp_models_train_y.pkl'.format(output))
+        torch.save({'x_std': torch.from_numpy(gp_norm['x_std']), 'y_std': torch.from_numpy(gp_norm['y_std'])}, '{}/gp_models_norm.pkl'.format(output))
 
     def seed(self, s):
         torch.manual_seed(s)
@@ -3,75 +3,238 @@ from copy import deepcopy
 from rcbf_sac.utils import euler_to_mat_2d, prCyan, prRed
 
 
-def generate_model_rollouts(env, memory_model, memory, agent, dynamics_model, k_horizon=1, batch_size=20, warmup=False):
+def generate_model_rollouts(env, memory_model, memory, agent, dynamics_model, k_horizon=1, batch_size=20, warmup=False, rollout_step=None):
+    """Rolls the policy out in the learned dynamics model from observations sampled from memory, and pushes the
+    transitions to memory_model.
 
-    # Sample a batch from memory
-    obs_batch, action_batch, reward_batch, next_obs_batch, mask_batch, t_batch, next_t_batch, cbf_info, next_cbf_info = memory.sample(batch_size=batch_size)
+    rollout_step is an optional ModelRolloutStep used instead of model_step to predict each step.
+    """
+
+    # Sample the start states uniformly from memory (not by priority with --prioritized_replay)
+    obs_batch, action_batch, reward_batch, next_obs_batch, mask_batch, t_batch, next_t_batch, cbf_info, next_cbf_info = memory.sample_uniform(batch_size=batch_size)
 
     obs_batch_ = deepcopy(obs_batch)
-    done_batch_ = [False for _ in range(batch_size)]
     t_batch_ = deepcopy(t_batch)
 
     for k in range(k_horizon):
 
-        batch_size_ = obs_batch_.shape[0]  # that's because we remove steps where done = True so batch_size shrinks
-
         # Sample action from policy
         action_batch_, cbf_action_batch_ = agent.select_action(obs_batch_, dynamics_model, warmup=warmup)  # Sample action from policy
 
-        state_batch_ = dynamics_model.get_state(obs_batch_)
-        next_state_mu_, next_state_std_, next_t_batch_ = dynamics_model.predict_next_state(state_batch_, action_batch_, t_batch=t_batch)
-        next_state_batch_ = np.random.normal(next_state_mu_, next_state_std_)
-        next_obs_batch_ = dynamics_model.get_obs(next_state_batch_)
+        if rollout_step is not None:
+            next_obs_batch_, reward_batch_, done_batch_, next_t_batch_ = rollout_step(obs_batch_, action_batch_, t_batch_)
+        else:
+            next_obs_batch_, reward_batch_, done_batch_, next_t_batch_ = model_step(env, dynamics_model, obs_batch_, action_batch_, t_batch_)
+        mask_batch_ = np.invert(done_batch_)
 
-        if env.dynamics_mode == 'Unicycle':
+        memory_model.batch_push(obs_batch_, action_batch_, reward_batch_, next_obs_batch_, mask_batch_, t_batch_,
+                                    next_t_batch_)  # Append transition to memory
 
-            # Construct Next Observation from State
-            dist2goal_prev = -np.log(obs_batch_[:, -1])
-            goal_rel = env.unwrapped.goal_pos[:2] - next_obs_batch_[:, :2]
-            dist2goal = np.linalg.norm(goal_rel, axis=1)
-            assert dist2goal.shape == (batch_size_,), 'dist2goal should be a vector of size (batch_size,), got {} instead'.format(dist2goal.shape)
-            # generate compass
-            compass = np.matmul(np.expand_dims(goal_rel, 1), euler_to_mat_2d(next_state_batch_[:, 2])).squeeze(1)
-            compass /= np.sqrt(np.sum(np.square(compass), axis=1, keepdims=True)) + 0.001
-            next_obs_batch_ = np.hstack((next_obs_batch_, compass, np.expand_dims(np.exp(-dist2goal), axis=-1)))
+        # Update Current Observation Batch
+        obs_batch_ = next_obs_batch_
+        t_batch_ = next_t_batch_
 
-            # Compute Reward
-            goal_size = 0.3
-            reward_goal = 1.0
-            reward_distance = 1.0
-            reward_batch_ = (dist2goal_prev - dist2goal) * reward_distance + (dist2goal <= goal_size) * reward_goal
-            # Compute Done
-            reached_goal = dist2goal <= goal_size
-            reward_batch_ += reward_goal * reached_goal
-            done_batch_ = reached_goal
-            mask_batch_ = np.invert(done_batch_)
+        # Delete Done Trajectories
+        if np.sum(done_batch_) > 0:
+            obs_batch_ = np.delete(obs_batch_, done_batch_ > 0, axis=0)
+            t_batch_ = np.delete(t_batch_, done_batch_ > 0, axis=0)
 
-        elif env.dynamics_mode == 'SimulatedCars':
+    return memory_model
 
-            # Compute Reward
-            # car_4_vel = next_state_batch_[:, 7]  # car's 4 velocity
-            # reward_batch_ = -np.abs(car_4_vel) * np.abs(action_batch_.squeeze()) * (action_batch_.squeeze() > 0) / env.max_episode_steps
-            reward_batch_ = -5.0 * np.abs(action_batch_.squeeze() ** 2) / env.max_episode_steps
 
-            # Compute Done
-            done_batch_ = next_t_batch_ >= env.max_episode_steps * env.dt  # done?
-            mask_batch_ = np.invert(done_batch_)
+def model_step(env, dynamics_model, obs_batch_, action_batch_, t_batch_):
+    """Predicts one step of the environment with the dynamics model.
 
-        else:
-            raise Exception('Environment/Dynamics mode {} not Recognized!'.format(env.dynamics_mode))
+    Returns
+    -------
+    next_obs_batch_ : ndarray
+    reward_batch_ : ndarray
+    done_batch_ : ndarray
+    next_t_batch_ : ndarray
+    """
 
-        memory_model.batch_push(obs_batch_, action_batch_, reward_batch_, next_obs_batch_, mask_batch_, t_batch_,
-                                    next_t_batch_)  # Append transition to memory
+    batch_size_ = obs_batch_.shape[0]  # that's because we remove steps where done = True so batch_size shrinks
 
+    state_batch_ = dynamics_model.get_state(obs_batch_)
+    next_state_mu_, next_state_std_, next_t_batch_ = dynamics_model.predict_next_state(state_batch_, action_batch_, t_batch=t_batch_)
+    next_state_batch_ = np.random.normal(next_state_mu_, next_state_std_)
+    next_obs_batch_ = dynamics_model.get_obs(next_state_batch_)
 
-        t_batch_ = deepcopy(next_t_batch_)
+    if env.dynamics_mode == 'Unicycle':
 
-        # Update Current Observation Batch
-        obs_batch_ = deepcopy(next_obs_batch_)
+        # Construct Next Observation from State
+        dist2goal_prev = -np.log(obs_batch_[:, -1])
+        goal_rel = env.unwrapped.goal_pos[:2] - next_obs_batch_[:, :2]
+        dist2goal = np.linalg.norm(goal_rel, axis=1)
+        assert dist2goal.shape == (batch_size_,), 'dist2goal should be a vector of size (batch_size,), got {} instead'.format(dist2goal.shape)
+        # generate compass
+        compass = np.matmul(np.expand_dims(goal_rel, 1), euler_to_mat_2d(next_state_batch_[:, 2])).squeeze(1)
+        compass /= np.sqrt(np.sum(np.square(compass), axis=1, keepdims=True)) + 0.001
+        next_obs_batch_ = np.hstack((next_obs_batch_, compass, np.expand_dims(np.exp(-dist2goal), axis=-1)))
 
-        # Delete Done Trajectories
-        if np.sum(done_batch_) > 0:
-            obs_batch_ = np.delete(obs_batch_, done_batch_ > 0, axis=0)
+        # Compute Reward
+        goal_size = 0.3
+        reward_goal = 1.0
+        reward_distance = 1.0
+        reward_batch_ = (dist2goal_prev - dist2goal) * reward_distance + (dist2goal <= goal_size) * reward_goal
+        # Compute Done
+        reached_goal = dist2goal <= goal_size
+        reward_batch_ += reward_goal * reached_goal
+        done_batch_ = reached_goal
+
+    elif env.dynamics_mode == 'SimulatedCars':
+
+        # Compute Reward
+        # car_4_vel = next_state_batch_[:, 7]  # car's 4 velocity
+        # reward_batch_ = -np.abs(car_4_vel) * np.abs(action_batch_.squeeze()) * (action_batch_.squeeze() > 0) / env.max_episode_steps
+        reward_batch_ = -5.0 * np.abs(action_batch_.squeeze() ** 2) / env.max_episode_steps
+
+        # Compute Done
+        done_batch_ = next_t_batch_ >= env.max_episode_steps * env.dt  # done?
+
+    else:
+        raise Exception('Environment/Dynamics mode {} not Recognized!'.format(env.dynamics_mode))
+
+    return next_obs_batch_, reward_batch_, done_batch_, next_t_batch_
 
-    return memory_model
\ No newline at end of file
+
+class ModelRolloutStep:
+    """Same as model_step, fused into one pass of in-place numpy operations on buffers allocated once (and grown when
+    a bigger batch comes in) instead of a dozen temporary arrays per step.
+
+    The returned arrays are views into these buffers, so they're only valid until the next call but one (next_obs
+    alternates between two buffers so that it can be fed back as the next call's obs_batch). The next state is sampled
+    from its own generator, seeded from np.random.
+    """
+
+    def __init__(self, env, dynamics_model, batch_size=256):
+
+        if env.dynamics_mode not in ('Unicycle', 'SimulatedCars'):
+            raise Exception('Environment/Dynamics mode {} not Recognized!'.format(env.dynamics_mode))
+
+        self.env = env
+        self.dynamics_model = dynamics_model
+        self.n_s = dynamics_model.n_s
+        self.n_o = 7 if env.dynamics_mode == 'Unicycle' else self.n_s
+        self.rng = np.random.default_rng(np.random.randint(2 ** 32))
+        self.capacity = 0
+        self._allocate(batch_size)
+        self.flip = 0  # which of the two next_obs buffers to write
+
+    def _allocate(self, batch_size):
+        # Column-major (one row per feature), so that each feature is a contiguous slice
+        self.state = np.empty((self.n_s, batch_size))
+        self.next_state = np.empty((self.n_s, batch_size))
+        self.noise = np.empty((self.n_s, batch_size))
+        self.obs = [np.empty((self.n_o, batch_size)), np.empty((self.n_o, batch_size))]
+        self.tmp = np.empty((3, batch_size))
+        self.reward = np.empty(batch_size)
+        self.done = np.empty(batch_size, dtype=bool)
+        self.capacity = batch_size
+
+    def __call__(self, obs_batch, action_batch, t_batch=None):
+        """
+        Parameters
+        ----------
+        obs_batch : ndarray
+            shape (batch_size, n_o)
+        action_batch : ndarray
+            shape (batch_size, n_u)
+        t_batch : ndarray, optional
+
+        Returns
+        -------
+        next_obs_batch : ndarray
+            shape (batch_size, n_o)
+        reward_batch : ndarray
+            shape (batch_size,)
+        done_batch : ndarray
+            shape (batch_size,)
+        next_t_batch : ndarray
+        """
+
+        n = obs_batch.shape[0]
+        if n > self.capacity:
+            self._allocate(max(n, 2 * self.capacity))
+        state, next_state, noise = self.state[:, :n], self.next_state[:, :n], self.noise[:, :n]
+        next_obs = self.obs[self.flip][:, :n]
+        self.flip = 1 - self.flip
+        reward, done = self.reward[:n], self.done[:n]
+        dt = self.env.dt
+
+        if self.env.dynamics_mode == 'Unicycle':
+
+            c, s, dist = self.tmp[0, :n], self.tmp[1, :n], self.tmp[2, :n]
+
+            # State
+            state[0] = obs_batch[:, 0]
+            state[1] = obs_batch[:, 1]
+            np.arctan2(obs_batch[:, 3], obs_batch[:, 2], out=state[2])
+            disturb_mean, disturb_std = self.dynamics_model.predict_disturbance(state.T)
+
+            # Next state ~ N(state + dt * (g(state) u + disturbance mean), dt * disturbance std)
+            np.cos(state[2], out=c)
+            np.sin(state[2], out=s)
+            np.multiply(c, action_batch[:, 0], out=next_state[0])
+            np.multiply(s, action_batch[:, 0], out=next_state[1])
+            next_state[2] = action_batch[:, 1]
+            next_state += disturb_mean.T
+            self.rng.standard_normal(out=noise)
+            noise *= disturb_std.T
+            next_state += noise
+            next_state *= dt
+            next_state += state
+
+            # Next observation: [pos_x, pos_y, cos(theta), sin(theta), xdir2goal, ydir2goal, exp(-dist2goal)]
+            goal = self.env.unwrapped.goal_pos
+            next_obs[:2] = next_state[:2]
+            np.cos(next_state[2], out=next_obs[2])
+            np.sin(next_state[2], out=next_obs[3])
+            np.subtract(goal[0], next_state[0], out=c)  # goal_rel
+            np.subtract(goal[1], next_state[1], out=s)
+            np.hypot(c, s, out=dist)
+            # compass = goal_rel @ R(theta), normalized
+            np.multiply(c, next_obs[2], out=next_obs[4])
+            np.multiply(c, next_obs[3], out=next_obs[5])
+            np.multiply(s, next_obs[3], out=c)
+            next_obs[4] += c
+            np.multiply(s, next_obs[2], out=c)
+            np.subtract(c, next_obs[5], out=next_obs[5])
+            np.hypot(next_obs[4], next_obs[5], out=c)
+            c += 0.001
+            next_obs[4] /= c
+            next_obs[5] /= c
+            np.negative(dist, out=c)
+            np.exp(c, out=next_obs[6])
+
+            # Reward: progress towards the goal, plus 2 * reward_goal (as in model_step) once within goal_size
+            goal_size = 0.3
+            reward_goal = 1.0
+            np.log(obs_batch[:, -1], out=reward)
+            reward += dist
+            np.negative(reward, out=reward)
+            np.less_equal(dist, goal_size, out=done)
+            reward += 2 * reward_goal * done
+
+            next_t_batch = t_batch + dt if t_batch is not None else None
+
+        else:  # SimulatedCars
+
+            # State (scaled observation)
+            state[:] = obs_batch.T
+            state[::2] *= 100.0  # Scale Positions
+            state[1::2] *= 30.0  # Scale Velocities
+            next_state_mu, next_state_std, next_t_batch = self.dynamics_model.predict_next_state(state.T, action_batch, t_batch=t_batch)
+            self.rng.standard_normal(out=noise)
+            noise *= next_state_std.T
+            np.add(next_state_mu.T, noise, out=next_state)
+
+            np.copyto(next_obs, next_state)
+            next_obs[::2] /= 100.0  # Scale Positions
+            next_obs[1::2] /= 30.0  # Scale Velocities
+
+            np.square(action_batch.reshape(n), out=reward)
+            reward *= -5.0 / self.env.max_episode_steps
+            np.greater_equal(next_t_batch.reshape(n), self.env.max_episode_steps * dt, out=done)
+
+        return next_obs.T, reward, done, next_t_batch
@@ -0,0 +1,77 @@
+""" Benchmarks the fit and predict latency (and accuracy) of the disturbance estimators as the number of training
+points grows, on a synthetic disturbance over a Unicycle-like state space.
+
+Example:
+    python -m rcbf_sac.gp_benchmark --sizes 1000 2000 5000 20000 --backends exact svgp rff
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+from rcbf_sac.gp_model import GPyDisturbanceEstimator, SVGPDisturbanceEstimator, RFFDisturbanceEstimator
+
+
+def make_estimator(backend, train_x, train_y, prior_std, device, num_inducing=256, num_features=256):
+
+    if backend == 'exact':
+        return GPyDisturbanceEstimator(train_x, train_y, prior_std, device=device)
+    elif backend == 'svgp':
+        return SVGPDisturbanceEstimator(train_x, train_y, prior_std, device=device, num_inducing=num_inducing)
+    elif backend == 'rff':
+        return RFFDisturbanceEstimator(train_x, train_y, prior_std, device=device, num_features=num_features)
+    raise Exception('Unknown backend {}'.format(backend))
+
+
+def disturbance(x):
+    """Smooth synthetic disturbance of the first state dimension."""
+    return 0.2 * np.sin(x[:, 0]) * np.cos(x[:, 1]) + 0.1 * np.sin(x[:, 2])
+
+
+def benchmark(backend, n_train, args, device):
+
+    rng = np.random.default_rng(args.seed)
+    train_x = rng.uniform(-3, 3, size=(n_train, args.n_s))
+    train_y = disturbance(train_x) + 0.01 * rng.normal(size=n_train)
+    test_x = rng.uniform(-3, 3, size=(args.n_test, args.n_s))
+
+    torch.manual_seed(args.seed)
+    start = time.perf_counter()
+    estimator = make_estimator(backend, train_x, train_y, 0.2, device, args.num_inducing, args.num_features)
+    estimator.train(args.training_iter)
+    fit_time = time.perf_counter() - start
+
+    estimator.predict(test_x, full_cov=False)  # first call builds the prediction caches
+    start = time.perf_counter()
+    for _ in range(args.n_predict):
+        prediction = estimator.predict(test_x, full_cov=False)
+    predict_time = (time.perf_counter() - start) / args.n_predict
+
+    rmse = np.sqrt(np.mean((prediction['mean'] - disturbance(test_x)) ** 2))
+    return fit_time, predict_time, rmse
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 5000])
+    parser.add_argument('--backends', type=str, nargs='+', default=['exact', 'svgp', 'rff'])
+    parser.add_argument('--n_s', type=int, default=3, help='State dimension')
+    parser.add_argument('--n_test', type=int, default=256, help='Number of points per predict call')
+    parser.add_argument('--n_predict', type=int, default=10, help='Number of predict calls to average over')
+    parser.add_argument('--training_iter', type=int, default=70)
+    parser.add_argument('--num_inducing', type=int, default=256)
+    parser.add_argument('--num_features', type=int, default=256)
+    parser.add_argument('--max_exact_size', type=int, default=10000, help='Skip the exact GP above this size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cuda', action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    print('{:>8} {:>8} {:>10} {:>14} {:>8}'.format('backend', 'N', 'fit (s)', 'predict (ms)', 'rmse'))
+    for n_train in args.sizes:
+        for backend in args.backends:
+            if backend == 'exact' and n_train > args.max_exact_size:
+                continue
+            fit_time, predict_time, rmse = benchmark(backend, n_train, args, device)
+            print('{:>8} {:>8} {:>10.3f} {:>14.3f} {:>8.4f}'.format(backend, n_train, fit_time, 1e3 * predict_time, rmse))
@@ -4,8 +4,10 @@ https://docs.gpytorch.ai/en/stable/examples/02_Scalable_Exact_GPs/Simple_GP_Regr
 Training is performed rapidly (and exactly) using GPUs and prediction is done very rapidly using LOVE.
 """
 
+import math
 import torch
 import gpytorch
+from linear_operator.utils.memoize import add_to_cache, get_from_cache, CachingError
 from rcbf_sac.utils import to_tensor, to_numpy
 
 
@@ -54,8 +56,14 @@ class GPyDisturbanceEstimator:
 
         self.model = BaseGPy(train_x, train_y, prior_std, likelihood)
         self.model = self.model.to(self.device)
+        self.optimizer_state = None  # Adam state to resume training from, see warm_start
 
-    def train(self, training_iter, verbose=False):
+    def train(self, training_iter, verbose=False, tol=None):
+        """Trains the hyperparameters for at most training_iter iterations.
+
+        If tol is given, training stops early once the loss (negative marginal log likelihood) changes by less than tol
+        between two iterations. Returns the number of iterations used.
+        """
 
         # Find optimal model hyperparameters
         self.model.train()
@@ -63,10 +71,13 @@ class GPyDisturbanceEstimator:
 
         # Use the adam optimizer
         optimizer = torch.optim.Adam(self.model.parameters(), lr=0.1)  # Includes GaussianLikelihood parameters
+        if self.optimizer_state is not None:
+            optimizer.load_state_dict(self.optimizer_state)
 
         # "Loss" for GPs - the marginal log likelihood
         mll = gpytorch.mlls.ExactMarginalLogLikelihood(self.likelihood, self.model)
 
+        prev_loss = None
         for i in range(training_iter):
             # Zero gradients from previous iteration
             optimizer.zero_grad()
@@ -82,29 +93,366 @@ class GPyDisturbanceEstimator:
                     self.model.likelihood.noise.item()
                 ))
             optimizer.step()
+            if tol is not None and prev_loss is not None and abs(prev_loss - loss.item()) < tol:
+                break
+            prev_loss = loss.item()
+
+        self.optimizer_state = optimizer.state_dict()
+        return i + 1 if training_iter > 0 else 0
+
+    def warm_start(self, other):
+        """Initializes the hyperparameters (and the optimizer state) from another estimator of the same shape."""
+
+        self.model.load_state_dict(other.model.state_dict())
+        self.optimizer_state = other.optimizer_state
 
-    def predict(self, test_x):
+    def predict(self, test_x, full_cov=True):
+        """Predicts the mean and variance at test_x, plus the full covariance matrix and confidence region if full_cov.
+
+        Computing the covariance matrix is O(n_test^2), so callers that only need the variances should pass
+        full_cov=False. The posterior caches built by the first prediction are kept until the model is trained again.
+        Tensor inputs get tensor predictions on the model's device, ndarray inputs get ndarray predictions.
+        """
 
         # Convert to torch tensor
         is_tensor = torch.is_tensor(test_x)
         if not is_tensor:
            test_x = to_tensor(test_x, torch.FloatTensor, self.device)
+        else:
+            test_x = test_x.to(device=self.device, dtype=torch.float32)
 
-        # Get into evaluation (predictive posterior) mode
-        self.model.eval()
-        self.likelihood.eval()
+        # Get into evaluation (predictive posterior) mode, switching back to train mode would drop the cached posterior
+        if self.model.training:
+            self.model.eval()
+            self.likelihood.eval()
 
         # Test points are regularly spaced along [0,1]
         # Make predictions by feeding model through likelihood
         with torch.no_grad(), gpytorch.settings.fast_pred_var():
             observed_pred = self.likelihood(self.model(test_x))
             pred_dict = dict()
-            pred_dict['mean'] = observed_pred.mean.cpu()
-            pred_dict['f_var'] = observed_pred.variance.cpu()
-            pred_dict['f_covar'] = observed_pred.covariance_matrix.cpu()
-            lower_ci, upper_ci = observed_pred.confidence_region()
-            pred_dict['lower_ci'] = lower_ci.cpu()
-            pred_dict['upper_ci'] = upper_ci.cpu()
+            pred_dict['mean'] = observed_pred.mean
+            pred_dict['f_var'] = observed_pred.variance
+            if full_cov:
+                pred_dict['f_covar'] = observed_pred.covariance_matrix
+                lower_ci, upper_ci = observed_pred.confidence_region()
+                pred_dict['lower_ci'] = lower_ci
+                pred_dict['upper_ci'] = upper_ci
+
+        # If they gave us ndarray, we give back ndarray
+        if not is_tensor:
+            for key, val in pred_dict.items():
+                pred_dict[key] = to_numpy(val)
+
+        return pred_dict
+
+    def update_posterior(self, new_x, new_y):
+        """Conditions the GP on new data points without retraining its hyperparameters. The cached posterior gets a
+        low-rank update (O(k N^2) for k new points) instead of being recomputed.
+        """
+
+        if not torch.is_tensor(new_x):
+            new_x = to_tensor(new_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(new_y):
+            new_y = to_tensor(new_y, torch.FloatTensor, self.device)
+
+        self.model = _fantasy_model(self.model, self.likelihood, new_x, new_y)
+        self.likelihood = self.model.likelihood
+        self.train_x = self.model.train_inputs[0]
+        self.train_y = self.model.train_targets
+
+    def set_train_data(self, train_x, train_y):
+        """Replaces the training data but keeps the hyperparameters, the posterior is recomputed on the next predict."""
+
+        if not torch.is_tensor(train_x):
+            train_x = to_tensor(train_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(train_y):
+            train_y = to_tensor(train_y, torch.FloatTensor, self.device)
+        self.train_x = train_x
+        self.train_y = train_y
+        self.model.set_train_data(train_x, train_y, strict=False)
+
+
+class BatchedBaseGPy(gpytorch.models.ExactGP):
+    """Independent GPs for each output dimension, as a single ExactGP with a batch dimension over the outputs.
+
+    Each output has its own kernel hyperparameters and noise (same priors as BaseGPy), so this is equivalent to n_out
+    BaseGPy models but all of them are trained and evaluated together in batched tensor ops.
+    """
+
+    def __init__(self, train_x, train_y, prior_std, likelihood):
+        super().__init__(train_x, train_y, likelihood)
+        batch_shape = torch.Size([prior_std.shape[0]])
+        self.mean_module = gpytorch.means.ZeroMean(batch_shape=batch_shape)
+        self.covar_module = gpytorch.kernels.ScaleKernel(
+                            gpytorch.kernels.RBFKernel(batch_shape=batch_shape, lengthscale_prior=gpytorch.priors.NormalPrior(1e5, 1e-5)),
+                            batch_shape=batch_shape,
+                            outputscale_prior=gpytorch.priors.NormalPrior(prior_std + 1e-6, 1e-5))
+        # Initialize lengthscale and outputscale to mean of priors
+        self.covar_module.base_kernel.lengthscale = 1e5
+        self.covar_module.outputscale = prior_std + 1e-6
+
+    def forward(self, x):
+        mean = self.mean_module(x)
+        covar = self.covar_module(x)
+        return gpytorch.distributions.MultivariateNormal(mean, covar)
+
+
+class BatchedGPyDisturbanceEstimator:
+    """
+    Same interface as GPyDisturbanceEstimator but for multi-output data, train_y has shape (n_train, n_out) and the
+    predictions have shape (n_test, n_out) (f_covar is (n_out, n_test, n_test)). Every output dimension gets its own
+    GP, but all of them are trained with a single optimizer loop and predicted with a single call.
+    """
+
+    def __init__(self, train_x, train_y, prior_std, likelihood=None, device=None):
+
+        if device:
+            self.device = device
+        else:
+            self.device = torch.device("cpu")
+
+        if not torch.is_tensor(train_x):
+            train_x = to_tensor(train_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(train_y):
+            train_y = to_tensor(train_y, torch.FloatTensor, self.device)
+        if not torch.is_tensor(prior_std):
+            prior_std = torch.tensor(prior_std, dtype=torch.float32, device=self.device)
+        self.n_out = train_y.shape[1]
+        # Batch of n_out GPs sharing the same inputs
+        self.train_x = train_x.unsqueeze(0).expand(self.n_out, *train_x.shape)
+        self.train_y = train_y.t().contiguous()
+
+        if not likelihood:
+            likelihood = gpytorch.likelihoods.GaussianLikelihood(batch_shape=torch.Size([self.n_out]))
+        self.likelihood = likelihood.to(self.device)
+
+        self.model = BatchedBaseGPy(self.train_x, self.train_y, prior_std, likelihood)
+        self.model = self.model.to(self.device)
+        self.optimizer_state = None  # Adam state to resume training from, see warm_start
+
+    def train(self, training_iter, verbose=False, tol=None):
+        """Same as GPyDisturbanceEstimator.train, the early stopping test uses the loss averaged over the outputs."""
+
+        # Find optimal model hyperparameters
+        self.model.train()
+        self.likelihood.train()
+
+        # Use the adam optimizer
+        optimizer = torch.optim.Adam(self.model.parameters(), lr=0.1)  # Includes GaussianLikelihood parameters
+        if self.optimizer_state is not None:
+            optimizer.load_state_dict(self.optimizer_state)
+
+        # "Loss" for GPs - the marginal log likelihood
+        mll = gpytorch.mlls.ExactMarginalLogLikelihood(self.likelihood, self.model)
+
+        prev_loss = None
+        for i in range(training_iter):
+            optimizer.zero_grad()
+            output = self.model(self.train_x)
+            # The GPs are independent, so summing their losses gives each one its own gradients
+            loss = -mll(output, self.train_y).sum()
+            loss.backward()
+            if verbose:
+                print('\tIter %d/%d - Loss: %.3f' % (i + 1, training_iter, loss.item()))
+            optimizer.step()
+            if tol is not None and prev_loss is not None and abs(prev_loss - loss.item()) / self.n_out < tol:
+                break
+            prev_loss = loss.item()
+
+        self.optimizer_state = optimizer.state_dict()
+        return i + 1 if training_iter > 0 else 0
+
+    def warm_start(self, other):
+        """Initializes the hyperparameters (and the optimizer state) from another estimator of the same shape."""
+
+        self.model.load_state_dict(other.model.state_dict())
+        self.optimizer_state = other.optimizer_state
+
+    def predict(self, test_x, full_cov=True):
+
+        # Convert to torch tensor
+        is_tensor = torch.is_tensor(test_x)
+        if not is_tensor:
+            test_x = to_tensor(test_x, torch.FloatTensor, self.device)
+        else:
+            test_x = test_x.to(device=self.device, dtype=torch.float32)
+
+        # Get into evaluation (predictive posterior) mode
+        if self.model.training:
+            self.model.eval()
+            self.likelihood.eval()
+
+        with torch.no_grad(), gpytorch.settings.fast_pred_var():
+            observed_pred = self.likelihood(self.model(test_x.unsqueeze(0).expand(self.n_out, *test_x.shape)))
+            pred_dict = dict()
+            pred_dict['mean'] = observed_pred.mean.t()
+            pred_dict['f_var'] = observed_pred.variance.t()
+            if full_cov:
+                pred_dict['f_covar'] = observed_pred.covariance_matrix
+                lower_ci, upper_ci = observed_pred.confidence_region()
+                pred_dict['lower_ci'] = lower_ci.t()
+                pred_dict['upper_ci'] = upper_ci.t()
+
+        # If they gave us ndarray, we give back ndarray
+        if not is_tensor:
+            for key, val in pred_dict.items():
+                pred_dict[key] = to_numpy(val)
+
+        return pred_dict
+
+    def update_posterior(self, new_x, new_y):
+        """Batched version of GPyDisturbanceEstimator.update_posterior, new_y has shape (k, n_out)."""
+
+        if not torch.is_tensor(new_x):
+            new_x = to_tensor(new_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(new_y):
+            new_y = to_tensor(new_y, torch.FloatTensor, self.device)
+
+        self.model = _fantasy_model(self.model, self.likelihood, new_x.unsqueeze(0).expand(self.n_out, *new_x.shape), new_y.t())
+        self.likelihood = self.model.likelihood
+        self.train_x = self.model.train_inputs[0]
+        self.train_y = self.model.train_targets
+
+    def set_train_data(self, train_x, train_y):
+        """Batched version of GPyDisturbanceEstimator.set_train_data, train_y has shape (n_train, n_out)."""
+
+        if not torch.is_tensor(train_x):
+            train_x = to_tensor(train_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(train_y):
+            train_y = to_tensor(train_y, torch.FloatTensor, self.device)
+        self.train_x = train_x.unsqueeze(0).expand(self.n_out, *train_x.shape)
+        self.train_y = train_y.t().contiguous()
+        self.model.set_train_data(self.train_x, self.train_y, strict=False)
+
+    def load_unbatched_state_dicts(self, state_dicts):
+        """Loads the weights of n_out GPyDisturbanceEstimator models (one state_dict per output dimension)."""
+
+        state_dict = self.model.state_dict()
+        for key, value in state_dict.items():
+            stacked = torch.stack([d[key] for d in state_dicts])
+            # Batched parameters get one entry per output, the rest (e.g. shared priors) are the same for all outputs
+            state_dict[key] = stacked.reshape(value.shape) if stacked.numel() == value.numel() else state_dicts[0][key]
+        self.model.load_state_dict(state_dict)
+
+
+class BaseSVGPy(gpytorch.models.ApproximateGP):
+    """Sparse variational GP with learned inducing points, same kernel and priors as BaseGPy."""
+
+    def __init__(self, inducing_points, prior_std):
+        variational_distribution = gpytorch.variational.CholeskyVariationalDistribution(inducing_points.shape[0])
+        variational_strategy = gpytorch.variational.VariationalStrategy(self, inducing_points, variational_distribution, learn_inducing_locations=True)
+        super().__init__(variational_strategy)
+        self.mean_module = gpytorch.means.ZeroMean()
+        self.covar_module = gpytorch.kernels.ScaleKernel(
+                            gpytorch.kernels.RBFKernel(lengthscale_prior=gpytorch.priors.NormalPrior(1e5, 1e-5)),
+                            outputscale_prior=gpytorch.priors.NormalPrior(prior_std + 1e-6, 1e-5))
+        # Initialize lengthscale and outputscale to mean of priors
+        self.covar_module.base_kernel.lengthscale = 1e5
+        self.covar_module.outputscale = prior_std + 1e-6
+
+    def forward(self, x):
+        mean = self.mean_module(x)
+        covar = self.covar_module(x)
+        return gpytorch.distributions.MultivariateNormal(mean, covar)
+
+
+class SVGPDisturbanceEstimator:
+    """
+    Same interface as GPyDisturbanceEstimator but backed by a sparse variational GP with num_inducing inducing points,
+    trained on random minibatches of the training data. Training and prediction cost O(num_inducing^2) per point
+    instead of growing as O(N^3) and O(N) with the number of training points, so it can handle much larger histories.
+    """
+
+    def __init__(self, train_x, train_y, prior_std, likelihood=None, device=None, num_inducing=256, batch_size=1024):
+
+        if device:
+            self.device = device
+        else:
+            self.device = torch.device("cpu")
+
+        if not torch.is_tensor(train_x):
+            train_x = to_tensor(train_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(train_y):
+            train_y = to_tensor(train_y, torch.FloatTensor, self.device)
+        self.train_x = train_x
+        self.train_y = train_y
+        self.batch_size = batch_size
+
+        if not likelihood:
+            likelihood = gpytorch.likelihoods.GaussianLikelihood()
+        self.likelihood = likelihood.to(self.device)
+
+        # Initialize the inducing points on a random subset of the training inputs
+        inducing_idxs = torch.randperm(train_x.shape[0], device=self.device)[:num_inducing]
+        self.model = BaseSVGPy(train_x[inducing_idxs].clone(), prior_std)
+        self.model.likelihood = self.likelihood  # so that the likelihood's parameters are trained and saved with the model
+        self.model = self.model.to(self.device)
+        self.optimizer_state = None  # Adam state to resume training from, see warm_start
+
+    def train(self, training_iter, verbose=False, tol=None):
+        """Runs training_iter optimizer steps, each on a random minibatch of batch_size training points. If tol is
+        given, training stops early once the loss (negative ELBO) changes by less than tol. Returns the number of
+        iterations used.
+        """
+
+        self.model.train()
+        self.likelihood.train()
+
+        optimizer = torch.optim.Adam(self.model.parameters(), lr=0.1)  # Includes GaussianLikelihood parameters
+        if self.optimizer_state is not None:
+            optimizer.load_state_dict(self.optimizer_state)
+
+        # "Loss" for SVGPs - the variational ELBO
+        mll = gpytorch.mlls.VariationalELBO(self.likelihood, self.model, num_data=self.train_y.shape[0])
+
+        prev_loss = None
+        for i in range(training_iter):
+            batch_idxs = torch.randint(self.train_x.shape[0], (min(self.batch_size, self.train_x.shape[0]),), device=self.device)
+            optimizer.zero_grad()
+            output = self.model(self.train_x[batch_idxs])
+            loss = -mll(output, self.train_y[batch_idxs])
+            loss.backward()
+            if verbose:
+                print('\tIter %d/%d - Loss: %.3f' % (i + 1, training_iter, loss.item()))
+            optimizer.step()
+            if tol is not None and prev_loss is not None and abs(prev_loss - loss.item()) < tol:
+                break
+            prev_loss = loss.item()
+
+        self.optimizer_state = optimizer.state_dict()
+        return i + 1 if training_iter > 0 else 0
+
+    def warm_start(self, other):
+        """Initializes the hyperparameters, inducing points and variational distribution from another estimator."""
+
+        self.model.load_state_dict(other.model.state_dict())
+        self.optimizer_state = other.optimizer_state
+
+    def predict(self, test_x, full_cov=True):
+
+        # Convert to torch tensor
+        is_tensor = torch.is_tensor(test_x)
+        if not is_tensor:
+            test_x = to_tensor(test_x, torch.FloatTensor, self.device)
+        else:
+            test_x = test_x.to(device=self.device, dtype=torch.float32)
+
+        # Get into evaluation (predictive posterior) mode
+        if self.model.training:
+            self.model.eval()
+            self.likelihood.eval()
+
+        with torch.no_grad():
+            observed_pred = self.likelihood(self.model(test_x))
+            pred_dict = dict()
+            pred_dict['mean'] = observed_pred.mean
+            pred_dict['f_var'] = observed_pred.variance
+            if full_cov:
+                pred_dict['f_covar'] = observed_pred.covariance_matrix
+                lower_ci, upper_ci = observed_pred.confidence_region()
+                pred_dict['lower_ci'] = lower_ci
+                pred_dict['upper_ci'] = upper_ci
 
         # If they gave us ndarray, we give back ndarray
         if not is_tensor:
@@ -114,6 +462,206 @@ class GPyDisturbanceEstimator:
         return pred_dict
 
 
+class BaseRFF(torch.nn.Module):
+    """Random Fourier features approximating the RBF kernel of BaseGPy, with the same lengthscale prior and outputscale.
+
+    phi(x) = sqrt(2 outputscale / D) cos(W x / lengthscale + b), with W ~ N(0, I) and b ~ U(0, 2 pi), so that
+    phi(x) . phi(x') approximates outputscale * exp(-|x - x'|^2 / (2 lengthscale^2)).
+    """
+
+    def __init__(self, n_inputs, prior_std, num_features):
+        super().__init__()
+        self.register_buffer('W', torch.randn(num_features, n_inputs))
+        self.register_buffer('b', 2 * math.pi * torch.rand(num_features))
+        self.register_buffer('outputscale', torch.tensor(prior_std + 1e-6))  # as ScaleKernel's in BaseGPy
+        self.raw_lengthscale = torch.nn.Parameter(torch.tensor(math.log(1e5)))
+        self.raw_noise = torch.nn.Parameter(torch.tensor(0.))
+        self.lengthscale_prior = gpytorch.priors.NormalPrior(1e5, 1e-5)
+
+    @property
+    def lengthscale(self):
+        return self.raw_lengthscale.exp()
+
+    @property
+    def noise(self):
+        return torch.nn.functional.softplus(self.raw_noise) + 1e-4  # same constraint as GaussianLikelihood
+
+    def forward(self, x):
+        return torch.sqrt(2 * self.outputscale / self.W.shape[0]) * torch.cos(x @ self.W.t() / self.lengthscale + self.b)
+
+
+class RFFDisturbanceEstimator:
+    """
+    Same interface as GPyDisturbanceEstimator but approximates the GP by Bayesian linear regression on num_features
+    random Fourier features. Predictions cost O(D^2) per point (D = num_features) whatever the number of training
+    points, and new points are folded in with a D x D update. Training maximizes the (closed-form) marginal likelihood
+    of the regression with respect to the lengthscale and noise.
+    """
+
+    def __init__(self, train_x, train_y, prior_std, likelihood=None, device=None, num_features=256):
+
+        if device:
+            self.device = device
+        else:
+            self.device = torch.device("cpu")
+
+        if not torch.is_tensor(train_x):
+            train_x = to_tensor(train_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(train_y):
+            train_y = to_tensor(train_y, torch.FloatTensor, self.device)
+        self.train_x = train_x
+        self.train_y = train_y
+
+        self.model = BaseRFF(train_x.shape[1], prior_std, num_features).to(self.device)
+        self.optimizer_state = None  # Adam state to resume training from, see warm_start
+        self.cache = None  # (Phi^T Phi, Phi^T y, weights mean, cholesky of Phi^T Phi + noise I) of the posterior
+
+    def _posterior(self, phi_t_phi, phi_t_y):
+        """Returns the posterior weights mean and the Cholesky factor L of A = Phi^T Phi + noise I."""
+
+        noise = self.model.noise
+        L = torch.linalg.cholesky(phi_t_phi + noise * torch.eye(phi_t_phi.shape[0], device=self.device))
+        weights = torch.cholesky_solve(phi_t_y.unsqueeze(-1), L).squeeze(-1)
+        return weights, L
+
+    def _neg_log_evidence(self):
+        """Negative log marginal likelihood of the training data divided by the number of points (as gpytorch's
+        ExactMarginalLogLikelihood), including the lengthscale prior."""
+
+        phi = self.model(self.train_x)
+        n, d = phi.shape
+        noise = self.model.noise
+        weights, L = self._posterior(phi.t() @ phi, phi.t() @ self.train_y)
+        log_det_A = 2 * torch.log(torch.diagonal(L)).sum()
+        # Woodbury: y^T K^-1 y = (y^T y - y^T Phi A^-1 Phi^T y) / noise, log|K| = log|A| + (n - d) log(noise)
+        quad = (self.train_y @ self.train_y - self.train_y @ (phi @ weights)) / noise
+        neg_log_evidence = 0.5 * (quad + log_det_A + (n - d) * torch.log(noise) + n * math.log(2 * math.pi))
+        return (neg_log_evidence - self.model.lengthscale_prior.log_prob(self.model.lengthscale)) / n
+
+    def train(self, training_iter, verbose=False, tol=None):
+        """Same as GPyDisturbanceEstimator.train, then caches the posterior for prediction."""
+
+        optimizer = torch.optim.Adam(self.model.parameters(), lr=0.1)
+        if self.optimizer_state is not None:
+            optimizer.load_state_dict(self.optimizer_state)
+
+        prev_loss = None
+        i = -1
+        for i in range(training_iter):
+            optimizer.zero_grad()
+            loss = self._neg_log_evidence()
+            loss.backward()
+            if verbose:
+                print('\tIter %d/%d - Loss: %.3f   lengthscale: %.3f   noise: %.3f' % (
+                    i + 1, training_iter, loss.item(), self.model.lengthscale.item(), self.model.noise.item()))
+            optimizer.step()
+            if tol is not None and prev_loss is not None and abs(prev_loss - loss.item()) < tol:
+                break
+            prev_loss = loss.item()
+
+        self.optimizer_state = optimizer.state_dict()
+        self._update_cache()
+        return i + 1
+
+    def warm_start(self, other):
+        """Initializes the features, hyperparameters and the optimizer state from another estimator."""
+
+        self.model.load_state_dict(other.model.state_dict())
+        self.optimizer_state = other.optimizer_state
+
+    def _update_cache(self, phi_t_phi=None, phi_t_y=None):
+
+        with torch.no_grad():
+            if phi_t_phi is None:
+                phi = self.model(self.train_x)
+                phi_t_phi, phi_t_y = phi.t() @ phi, phi.t() @ self.train_y
+            weights, L = self._posterior(phi_t_phi, phi_t_y)
+        self.cache = (phi_t_phi, phi_t_y, weights, L)
+
+    def predict(self, test_x, full_cov=True):
+
+        # Convert to torch tensor
+        is_tensor = torch.is_tensor(test_x)
+        if not is_tensor:
+            test_x = to_tensor(test_x, torch.FloatTensor, self.device)
+        else:
+            test_x = test_x.to(device=self.device, dtype=torch.float32)
+
+        if self.cache is None:
+            self._update_cache()
+        _, _, weights, L = self.cache
+
+        with torch.no_grad():
+            noise = self.model.noise
+            phi = self.model(test_x)
+            # Posterior weights covariance is noise * A^-1, plus the observation noise
+            v = torch.linalg.solve_triangular(L, phi.t(), upper=False)
+            pred_dict = dict()
+            pred_dict['mean'] = phi @ weights
+            pred_dict['f_var'] = noise * (v ** 2).sum(0) + noise
+            if full_cov:
+                pred_dict['f_covar'] = noise * (v.t() @ v) + noise * torch.eye(test_x.shape[0], device=self.device)
+                std = pred_dict['f_var'].sqrt()
+                pred_dict['lower_ci'] = pred_dict['mean'] - 2 * std
+                pred_dict['upper_ci'] = pred_dict['mean'] + 2 * std
+
+        # If they gave us ndarray, we give back ndarray
+        if not is_tensor:
+            for key, val in pred_dict.items():
+                pred_dict[key] = to_numpy(val)
+
+        return pred_dict
+
+    def update_posterior(self, new_x, new_y):
+        """Conditions on new data points without retraining the hyperparameters, in O(k D^2 + D^3) whatever the number
+        of training points."""
+
+        if not torch.is_tensor(new_x):
+            new_x = to_tensor(new_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(new_y):
+            new_y = to_tensor(new_y, torch.FloatTensor, self.device)
+
+        if self.cache is None:
+            self._update_cache()
+        phi_t_phi, phi_t_y, _, _ = self.cache
+        with torch.no_grad():
+            phi = self.model(new_x)
+            self._update_cache(phi_t_phi + phi.t() @ phi, phi_t_y + phi.t() @ new_y)
+        self.train_x = torch.cat((self.train_x, new_x))
+        self.train_y = torch.cat((self.train_y, new_y))
+
+    def set_train_data(self, train_x, train_y):
+        """Replaces the training data but keeps the hyperparameters."""
+
+        if not torch.is_tensor(train_x):
+            train_x = to_tensor(train_x, torch.FloatTensor, self.device)
+        if not torch.is_tensor(train_y):
+            train_y = to_tensor(train_y, torch.FloatTensor, self.device)
+        self.train_x = train_x
+        self.train_y = train_y
+        self._update_cache()
+
+def _fantasy_model(model, likelihood, new_x, new_y):
+    """Returns a copy of model conditioned on the new points, using gpytorch's fantasy updates of the cached posterior."""
+
+    model.eval()
+    likelihood.eval()
+    with torch.no_grad():
+        if model.prediction_strategy is None:  # the posterior needs to be cached before it can be updated
+            model(new_x)
+        fantasy = model.get_fantasy_model(new_x, new_y)
+
+    # gpytorch stores the updated mean cache without the nan policy argument its lookups are keyed by, so the next
+    # prediction would recompute it from scratch (a full solve) instead of using the low-rank update
+    strategy = fantasy.prediction_strategy
+    try:
+        mean_cache = get_from_cache(strategy, 'mean_cache')
+    except CachingError:
+        return fantasy
+    add_to_cache(strategy, 'mean_cache', mean_cache, gpytorch.settings.observation_nan_policy.value())
+    return fantasy
+
+
 if __name__ == '__main__':
     """
     Simple code to test the GP model on a simple dataset. 
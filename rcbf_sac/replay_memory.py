@@ -1,35 +1,671 @@
-import random
+import os
+import pickle
+from collections import deque
 import numpy as np
 
+# Names of the columns stored for each transition, in the order they're pushed and sampled.
+FIELDS = ('state', 'action', 'reward', 'next_state', 'mask', 't', 'next_t', 'cbf_info', 'next_cbf_info')
+# Storage dtypes of the compressed mode. Observations and actions are low-dimensional and bounded in our envs so half
+# precision is enough for them, but times keep float32 (e.g. SimulatedCars' dynamics depend on sin(0.2 * t)).
+COMPRESSED_DTYPES = {'state': np.float16, 'action': np.float16, 'reward': np.float32, 'next_state': np.float16,
+                     'mask': np.uint8, 't': np.float32, 'next_t': np.float32, 'cbf_info': np.float32,
+                     'next_cbf_info': np.float32}
+
+
 class ReplayMemory:
+    """Columnar ring buffer of transitions.
+
+    Every field of a transition is stored in its own preallocated array of shape (capacity, *field_shape). The shape of
+    each field depends on the environment, so a column is only allocated the first time a (non-None) value is pushed
+    for it. Fields that were never pushed (e.g. cbf_info for envs that don't supply it) are sampled as None.
+
+    With compress=True the columns are stored with the smaller COMPRESSED_DTYPES (~4x less memory than float64) and
+    upcast back to dtype when sampled.
+    """
+
+    def __init__(self, capacity, seed, dtype=np.float64, compress=False):
 
-    def __init__(self, capacity, seed):
-        random.seed(seed)
         self.capacity = capacity
-        self.buffer = []
+        self.dtype = dtype
+        self.dtypes = dict(COMPRESSED_DTYPES) if compress else dict.fromkeys(FIELDS, dtype)
+        self.rng = np.random.default_rng(seed)
+        self.columns = dict()
         self.position = 0
+        self.size = 0
+        self.n_written = 0  # rows written since the buffer was created, see overwritten_since
 
     def push(self, state, action, reward, next_state, mask, t=None, next_t=None, cbf_info=None, next_cbf_info=None):
 
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(None)
-        self.buffer[self.position] = (state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info)
+        transition = (state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info)
+        for name, value in zip(FIELDS, transition):
+            if value is None:
+                continue
+            if name not in self.columns:
+                self._allocate(name, np.shape(value))
+            self.columns[name][self.position] = value
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.n_written += 1
 
     def batch_push(self, state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch=None, next_t_batch=None, cbf_info_batch=None, next_cbf_info_batch=None):
 
-        for i in range(state_batch.shape[0]):  # TODO: Optimize This
-            t_ = t_batch[i] if t_batch is not None else None
-            next_t_ = next_t_batch[i] if next_t_batch is not None else None
-            cbf_info_ = cbf_info_batch[i] if cbf_info_batch is not None else None
-            next_cbf_info_ = next_cbf_info_batch[i] if next_cbf_info_batch is not None else None
-            self.push(state_batch[i], action_batch[i], reward_batch[i], next_state_batch[i], mask_batch[i], t_, next_t_, cbf_info_, next_cbf_info_)  # Append transition to memory
+        transitions = (state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch, next_t_batch, cbf_info_batch, next_cbf_info_batch)
+        self._write_rows({name: values for name, values in zip(FIELDS, transitions) if values is not None}, state_batch.shape[0])
+
+    def _write_rows(self, rows, batch_size):
+        """Writes batch_size rows at the current position of the ring, rows maps column names to their values."""
+
+        # Only the last `capacity` rows would survive anyway
+        start = max(batch_size - self.capacity, 0)
+        n = batch_size - start
+        # Rows [0, n_head) go at the end of the ring, rows [n_head, n) wrap around to its start
+        n_head = min(n, self.capacity - self.position)
+
+        for name, values in rows.items():
+            values = np.asarray(values)
+            if name not in self.columns:
+                self._allocate(name, values.shape[1:])
+            if values.ndim == 0:  # scalar shared by the whole batch
+                values = np.broadcast_to(values, (batch_size,))
+            column = self.columns[name]
+            column[self.position:self.position + n_head] = values[start:start + n_head]
+            column[:n - n_head] = values[start + n_head:]
+
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.n_written += n
 
     def sample(self, batch_size):
+        return self._get_batch(self._sample_idxs(batch_size))
+
+    def sample_uniform(self, batch_size):
+        """Samples uniformly even if `sample` doesn't (e.g. PrioritizedReplayMemory), such as the start states of the
+        model rollouts."""
+        return self._get_batch(self._sample_idxs(batch_size))
+
+    def overwritten_since(self, idxs, position, n_written):
+        """Returns which of the ring slots idxs were written to since the buffer's position and n_written were the given
+        ones, e.g. to tell which sampled rows no longer hold the sampled transitions."""
+        return (idxs - position) % self.capacity < self.n_written - n_written
+
+    def field_shapes(self):
+        """Returns the shape of a single row of each field that has been pushed so far."""
+        return {name: column.shape[1:] for name, column in self.columns.items()}
+
+    def save(self, output, name='memory'):
+        """Saves the buffer as one .npy file per column (rows ordered oldest to newest) plus a small metadata file.
+
+        Parameters
+        ----------
+        output : str
+            Folder to save the buffer in.
+        name : str, optional
+            Prefix of the saved files, so that several buffers can be saved in the same folder.
+        """
+
+        # Oldest rows first: the stored rows are the `size` rows before position, wrapping around the end of the ring
+        start = (self.position - self.size) % self.capacity
+        n_head = min(self.size, self.capacity - start)
+        for field, column in self.columns.items():
+            saved = np.lib.format.open_memmap('{}/{}_{}.npy'.format(output, name, field), mode='w+', dtype=column.dtype, shape=(self.size,) + column.shape[1:])
+            saved[:n_head] = column[start:start + n_head]
+            saved[n_head:] = column[:self.size - n_head]
+            saved.flush()
+            del saved
+
+        meta = {'size': self.size, 'fields': list(self.columns.keys()), 'rng_state': self.rng.bit_generator.state}
+        with open('{}/{}_meta.pkl'.format(output, name), 'wb') as f:
+            pickle.dump(meta, f)
+
+    def load(self, output, name='memory'):
+        """Loads a buffer saved with `save`. If it exactly fills the buffer's capacity, the columns are memory-mapped
+        copy-on-write instead of being read in.
+
+        Returns
+        -------
+        loaded : bool
+            False if no saved buffer was found.
+        """
+
+        if output is None or not os.path.exists('{}/{}_meta.pkl'.format(output, name)):
+            return False
 
-        batch = random.sample(self.buffer, batch_size)
-        state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info = map(np.stack, zip(*batch))
-        return state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info
+        with open('{}/{}_meta.pkl'.format(output, name), 'rb') as f:
+            meta = pickle.load(f)
+
+        n = min(meta['size'], self.capacity)  # only keep the newest rows if the saved buffer is bigger
+        self.columns = dict()
+        for field in meta['fields']:
+            saved = np.load('{}/{}_{}.npy'.format(output, name, field), mmap_mode='c')
+            self._load_column(field, saved[meta['size'] - n:])
+
+        self.size = n
+        self.position = n % self.capacity
+        self.rng.bit_generator.state = meta['rng_state']
+        return True
+
+    def _load_column(self, name, saved):
+        if saved.shape[0] == self.capacity and saved.dtype == self.dtypes[name]:
+            self.columns[name] = saved
+        else:
+            self._allocate(name, saved.shape[1:])
+            self.columns[name][:saved.shape[0]] = saved
+
+    def _sample_idxs(self, batch_size):
+        return self.rng.choice(self.size, batch_size, replace=False)
+
+    def _get_batch(self, idxs, out=None):
+        """Gathers the rows at idxs from every column, returns None for columns that were never pushed.
+
+        If out is given (a tuple of arrays aligned with FIELDS, None for the fields to skip), the rows are written
+        directly into it instead of new arrays.
+        """
+
+        if out is None:
+            return tuple(self.columns[name][idxs].astype(self.dtype, copy=False) if name in self.columns else None for name in FIELDS)
+
+        for name, dst in zip(FIELDS, out):
+            if dst is not None:
+                _take(self.columns[name], idxs, dst)
+        return out
+
+    def _allocate(self, name, shape):
+        self.columns[name] = np.zeros((self.capacity,) + tuple(shape), dtype=self.dtypes[name])
 
     def __len__(self):
-        return len(self.buffer)
+        return self.size
+
+
+class DiskReplayMemory(ReplayMemory):
+    """ReplayMemory whose columns are numpy memmaps on disk, so capacity is bounded by disk rather than RAM.
+
+    The most recent transitions are kept in a small in-memory tail and written to disk in one slice per column when the
+    tail fills up (or on `flush`). Sampling reads from the memmaps and serves the rows still in the tail from RAM.
+    """
+
+    def __init__(self, capacity, seed, path, name='memory', tail_size=10000, dtype=np.float64, compress=False):
+
+        super().__init__(capacity, seed, dtype=dtype, compress=compress)
+        self.path = path
+        self.name = name
+        self.tail_size = min(tail_size, capacity)
+        self.tail = dict()
+        self.flushed = 0  # ring position of the first row in the tail
+        self.n_pending = 0  # number of rows in the tail that aren't on disk yet
+        os.makedirs(path, exist_ok=True)
+
+    def push(self, state, action, reward, next_state, mask, t=None, next_t=None, cbf_info=None, next_cbf_info=None):
+
+        if self.n_pending == self.tail_size:
+            self.flush()
+
+        transition = (state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info)
+        for name, value in zip(FIELDS, transition):
+            if value is None:
+                continue
+            if name not in self.columns:
+                self._allocate(name, np.shape(value))
+            self.tail[name][self.n_pending] = value
+        self.n_pending += 1
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.n_written += 1
+
+    def batch_push(self, state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch=None, next_t_batch=None, cbf_info_batch=None, next_cbf_info_batch=None):
+
+        batch_size = state_batch.shape[0]
+        transitions = (state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch, next_t_batch, cbf_info_batch, next_cbf_info_batch)
+
+        if self.n_pending + batch_size > self.tail_size:
+            self.flush()
+
+        if batch_size > self.tail_size:  # too big for the tail, write straight to disk
+            super().batch_push(*transitions)
+            self.flushed = self.position
+            return
+
+        for name, values in zip(FIELDS, transitions):
+            if values is None:
+                continue
+            values = np.asarray(values)
+            if name not in self.columns:
+                self._allocate(name, values.shape[1:])
+            self.tail[name][self.n_pending:self.n_pending + batch_size] = values
+        self.n_pending += batch_size
+        self.position = (self.position + batch_size) % self.capacity
+        self.size = min(self.size + batch_size, self.capacity)
+        self.n_written += batch_size
+
+    def flush(self):
+        """Writes the transitions in the in-memory tail to the memmaps."""
+
+        n_head = min(self.n_pending, self.capacity - self.flushed)
+        for name, column in self.columns.items():
+            tail = self.tail[name]
+            column[self.flushed:self.flushed + n_head] = tail[:n_head]
+            column[:self.n_pending - n_head] = tail[n_head:self.n_pending]
+        self.flushed = self.position
+        self.n_pending = 0
+
+    def save(self, output, name=None):
+        self.flush()
+        super().save(output, name or self.name)
+
+    def load(self, output, name=None):
+        self.tail = dict()
+        loaded = super().load(output, name or self.name)
+        self.flushed = self.position
+        self.n_pending = 0
+        return loaded
+
+    def _load_column(self, name, saved):
+        # Always copy into our own memmaps, mapping the snapshot copy-on-write would pull every written page into RAM
+        self._allocate(name, saved.shape[1:])
+        self.columns[name][:saved.shape[0]] = saved
+
+    def _get_batch(self, idxs, out=None):
+
+        batch = super()._get_batch(idxs, out)
+        if self.n_pending == 0:
+            return batch
+
+        # Rows that are still in the tail haven't been written to disk yet
+        tail_idxs = (idxs - self.flushed) % self.capacity
+        is_pending = tail_idxs < self.n_pending
+        tail_idxs = tail_idxs[is_pending]
+        for name, values in zip(FIELDS, batch):
+            if values is not None:
+                values[is_pending] = self.tail[name][tail_idxs]
+        return batch
+
+    def _allocate(self, name, shape):
+
+        filename = os.path.join(self.path, 'replay_{}_{}.dat'.format(self.name, name))
+        self.columns[name] = np.memmap(filename, dtype=self.dtypes[name], mode='w+', shape=(self.capacity,) + tuple(shape))
+        self.tail[name] = np.zeros((self.tail_size,) + tuple(shape), dtype=self.dtypes[name])
+
+
+class SumTree:
+    """Array-based binary sum-tree over `capacity` non-negative priorities.
+
+    Node i has children 2i and 2i+1, the root is node 1 and leaf j is stored at node `n_leaves + j`. Updates and
+    prefix-sum queries take O(log N) and are vectorized over batches of leaves.
+    """
+
+    def __init__(self, capacity):
+
+        self.n_leaves = 1
+        while self.n_leaves < capacity:
+            self.n_leaves *= 2
+        self.depth = int(np.log2(self.n_leaves))
+        self.tree = np.zeros(2 * self.n_leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idxs):
+        return self.tree[self.n_leaves + idxs]
+
+    def update(self, idxs, priorities):
+        """Sets the priorities of the leaves idxs and recomputes the sums of their ancestors."""
+
+        nodes = self.n_leaves + np.asarray(idxs)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the leaves whose priority intervals contain values (each in [0, total))."""
+
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape[0], dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.n_leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """ReplayMemory that samples transitions proportionally to priority^alpha (Schaul et al., 2016).
+
+    New transitions get the largest priority seen so far, and `update_priorities` should be called with the TD errors
+    of the transitions returned by `sample_prioritized`.
+    """
+
+    def __init__(self, capacity, seed, alpha=0.6, beta=0.4, eps=1e-6, dtype=np.float64, compress=False):
+
+        super().__init__(capacity, seed, dtype=dtype, compress=compress)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def push(self, state, action, reward, next_state, mask, t=None, next_t=None, cbf_info=None, next_cbf_info=None):
+
+        self.tree.update([self.position], self.max_priority ** self.alpha)
+        super().push(state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info)
+
+    def batch_push(self, state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch=None, next_t_batch=None, cbf_info_batch=None, next_cbf_info_batch=None):
+
+        n = min(state_batch.shape[0], self.capacity)
+        self.tree.update((self.position + np.arange(n)) % self.capacity, self.max_priority ** self.alpha)
+        super().batch_push(state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch, next_t_batch, cbf_info_batch, next_cbf_info_batch)
+
+    def sample(self, batch_size):
+        return self.sample_prioritized(batch_size)[0]
+
+    def sample_prioritized(self, batch_size):
+        """Samples a batch with one draw from each of batch_size equal slices of the total priority.
+
+        Returns
+        -------
+        batch : tuple
+            Same as `ReplayMemory.sample`.
+        idxs : ndarray
+            Indices of the sampled transitions, to be passed back to `update_priorities`.
+        weights : ndarray
+            Importance-sampling weights (N * P(i))^-beta, normalized by their max over the batch.
+        """
+
+        idxs, weights = self._sample_prioritized_idxs(batch_size)
+        return self._get_batch(idxs), idxs, weights
+
+    def _sample_prioritized_idxs(self, batch_size):
+
+        total = self.tree.total()
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * total / batch_size
+        idxs = np.minimum(self.tree.find(values), self.size - 1)  # guards against round-off past the last leaf
+
+        probs = self.tree.get(idxs) / total
+        weights = (self.size * probs) ** -self.beta
+        weights /= weights.max()
+        return idxs, weights
+
+    def update_priorities(self, idxs, td_errors):
+
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(idxs, priorities ** self.alpha)
+
+    def save(self, output, name='memory'):
+
+        super().save(output, name)
+        priorities = self.tree.get(np.arange(self.size))
+        np.save('{}/{}_priority.npy'.format(output, name), np.concatenate((priorities[self.position:], priorities[:self.position])))
+
+    def load(self, output, name='memory'):
+
+        if not super().load(output, name):
+            return False
+        priorities = np.load('{}/{}_priority.npy'.format(output, name))
+        self.tree = SumTree(self.capacity)
+        self.tree.update(np.arange(self.size), priorities[priorities.shape[0] - self.size:])
+        self.max_priority = max(1.0, priorities.max() ** (1 / self.alpha))
+        return True
+
+
+class TrajectoryReplayMemory(ReplayMemory):
+    """ReplayMemory that stores trajectories rather than independent transitions, so that each observation (and
+    cbf_info) is stored once instead of twice.
+
+    Row i of the ring holds the state, action, reward, mask, t and cbf_info of a transition, and its next_state, next_t
+    and next_cbf_info are read from row i+1. A push continues the current trajectory if its state equals the previous
+    next_state, otherwise the previous next_state is first written as a terminal row (valid=False) that only holds an
+    observation and is never sampled. The next_state of the newest transition is kept aside until the following push.
+    """
+
+    # Fields read from the row that follows the sampled one
+    NEXT_FIELDS = {'next_state': 'state', 'next_t': 't', 'next_cbf_info': 'cbf_info'}
+
+    def __init__(self, capacity, seed, dtype=np.float64, compress=False):
+
+        super().__init__(capacity, seed, dtype=dtype, compress=compress)
+        self.dtypes['valid'] = np.bool_
+        self.pending = None  # (next_state, next_t, next_cbf_info) of the newest transition
+        self.n_valid = 0  # number of rows that start a transition
+
+    def push(self, state, action, reward, next_state, mask, t=None, next_t=None, cbf_info=None, next_cbf_info=None):
+
+        if self.pending is not None and not np.array_equal(state, self.pending[0]):
+            self.close_trajectory()
+
+        row = {'state': state, 'action': action, 'reward': reward, 'mask': mask, 't': t, 'cbf_info': cbf_info, 'valid': True}
+        self._write_rows({name: np.expand_dims(value, 0) for name, value in row.items() if value is not None}, 1)
+        self.pending = (next_state, next_t, next_cbf_info)
+
+    def batch_push(self, state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch=None, next_t_batch=None, cbf_info_batch=None, next_cbf_info_batch=None):
+        """Pushes a batch of independent transitions, each followed by a terminal row holding its next_state."""
+
+        self.close_trajectory()
+        batch_size = state_batch.shape[0]
+        pairs = {'state': (state_batch, next_state_batch), 't': (t_batch, next_t_batch), 'cbf_info': (cbf_info_batch, next_cbf_info_batch)}
+        rows = {name: np.stack((values, next_values), axis=1).reshape((2 * batch_size,) + np.shape(values)[1:])
+                for name, (values, next_values) in pairs.items() if values is not None}
+        for name, values in (('action', action_batch), ('reward', reward_batch), ('mask', mask_batch)):
+            values = np.broadcast_to(values, (batch_size,) + np.shape(values)[1:])
+            rows[name] = np.repeat(values, 2, axis=0)  # the copies in the terminal rows are never read
+        rows['valid'] = np.tile([True, False], batch_size)
+        self._write_rows(rows, 2 * batch_size)
+
+    def close_trajectory(self):
+        """Writes the next_state of the newest transition as a terminal row."""
+
+        if self.pending is None:
+            return
+        next_state, next_t, next_cbf_info = self.pending
+        row = {'state': next_state, 't': next_t, 'cbf_info': next_cbf_info, 'valid': False}
+        self._write_rows({name: np.expand_dims(value, 0) for name, value in row.items() if value is not None}, 1)
+        self.pending = None
+
+    def field_shapes(self):
+        shapes = super().field_shapes()
+        shapes.pop('valid', None)
+        shapes.update({name: shapes[src] for name, src in self.NEXT_FIELDS.items() if src in shapes})
+        return shapes
+
+    def save(self, output, name='memory'):
+        self.close_trajectory()
+        super().save(output, name)
+
+    def load(self, output, name='memory'):
+
+        self.pending = None
+        if not super().load(output, name):
+            return False
+        self.n_valid = int(np.sum(self.columns['valid'][:self.size]))
+        # The oldest row has lost its predecessor, but the newest row needs a successor
+        newest = (self.position - 1) % self.capacity
+        if self.columns['valid'][newest]:
+            self.columns['valid'][newest] = False
+            self.n_valid -= 1
+        return True
+
+    def _write_rows(self, rows, batch_size):
+
+        # Keep count of the transitions that are overwritten
+        if 'valid' in self.columns and batch_size > 0:
+            n = min(batch_size, self.capacity)
+            n_head = min(n, self.capacity - self.position)
+            valid = self.columns['valid']
+            self.n_valid -= int(np.sum(valid[self.position:self.position + n_head]) + np.sum(valid[:n - n_head]))
+        super()._write_rows(rows, batch_size)
+        self.n_valid += int(np.sum(rows['valid'][-self.capacity:]))
+
+    def _sample_idxs(self, batch_size):
+
+        if batch_size > self.n_valid:
+            raise ValueError('Cannot sample {} transitions, only {} are stored.'.format(batch_size, self.n_valid))
+        # Rejection sampling, terminal rows are about one per episode so few candidates are rejected
+        n_candidates = batch_size + batch_size // 8 + 1
+        while True:
+            idxs = self.rng.choice(self.size, min(n_candidates, self.size), replace=False)
+            idxs = idxs[self.columns['valid'][idxs]]
+            if idxs.shape[0] >= batch_size:
+                return idxs[:batch_size]
+            n_candidates *= 2
+
+    def _get_batch(self, idxs, out=None):
+
+        next_idxs = (idxs + 1) % self.capacity
+        # The newest transition's next row hasn't been written yet
+        is_newest = next_idxs == self.position if self.pending is not None else np.zeros(idxs.shape[0], dtype=bool)
+
+        batch = []
+        for i, name in enumerate(FIELDS):
+            src, src_idxs = (self.NEXT_FIELDS[name], next_idxs) if name in self.NEXT_FIELDS else (name, idxs)
+            if src not in self.columns or (out is not None and out[i] is None):
+                batch.append(None)
+                continue
+            if out is None:
+                values = self.columns[src][src_idxs].astype(self.dtype, copy=False)
+            else:
+                values = _take(self.columns[src], src_idxs, out[i])
+            if name in self.NEXT_FIELDS and np.any(is_newest):
+                pending = self.pending[list(self.NEXT_FIELDS).index(name)]
+                if pending is not None:
+                    values[is_newest] = pending
+            batch.append(values)
+        return tuple(batch)
+
+    def __len__(self):
+        return self.n_valid
+
+
+class GenerationalReplayMemory(ReplayMemory):
+    """ReplayMemory for model-generated transitions that only keeps the ones generated in a recent window.
+
+    Every pushed batch is tagged with the current generation (e.g. the number of GP refits or of env steps, set with
+    `set_generation`). Since rows are written in order, each generation is a contiguous segment of the ring, and
+    evicting the oldest one only moves the start of the live region forward: its rows are dropped in O(1) without
+    being touched, and overwritten later. Rows older than `retention` generations are evicted whenever the generation
+    advances.
+    """
+
+    def __init__(self, capacity, seed, retention, dtype=np.float64, compress=False):
+
+        super().__init__(capacity, seed, dtype=dtype, compress=compress)
+        self.retention = retention
+        self.generation = 0
+        self.segments = deque()  # [generation, n_rows] of the live rows, oldest first
+        self.n_segment_rows = 0  # sum of the segments' n_rows
+
+    def set_generation(self, generation):
+        """Tags the following pushes with generation and evicts the rows older than the retention window.
+
+        Returns
+        -------
+        n_evicted : int
+            Number of rows evicted.
+        """
+
+        self.generation = generation
+        n_evicted = 0
+        while self.segments and self.segments[0][0] <= generation - self.retention:
+            n_evicted += self.segments.popleft()[1]
+        self.size -= n_evicted
+        self.n_segment_rows -= n_evicted
+        return n_evicted
+
+    def _write_rows(self, rows, batch_size):
+
+        super()._write_rows(rows, batch_size)
+        n = min(batch_size, self.capacity)
+        if self.segments and self.segments[-1][0] == self.generation:
+            self.segments[-1][1] += n
+        else:
+            self.segments.append([self.generation, n])
+        self.n_segment_rows += n
+        # Drop the rows that were overwritten once the ring wrapped around
+        excess = self.n_segment_rows - self.size
+        self.n_segment_rows -= max(excess, 0)
+        while excess > 0:
+            n_dropped = min(excess, self.segments[0][1])
+            self.segments[0][1] -= n_dropped
+            excess -= n_dropped
+            if self.segments[0][1] == 0:
+                self.segments.popleft()
+
+    def push(self, state, action, reward, next_state, mask, t=None, next_t=None, cbf_info=None, next_cbf_info=None):
+
+        transition = (state, action, reward, next_state, mask, t, next_t, cbf_info, next_cbf_info)
+        self._write_rows({name: np.expand_dims(value, 0) for name, value in zip(FIELDS, transition) if value is not None}, 1)
+
+    def load(self, output, name='memory'):
+        """Loads a buffer saved with `save`, the loaded rows are all tagged with the current generation."""
+
+        if not super().load(output, name):
+            return False
+        self.segments = deque([[self.generation, self.size]] if self.size else [])
+        self.n_segment_rows = self.size
+        return True
+
+    def _sample_idxs(self, batch_size):
+        # The live rows are the `size` rows before position
+        return (self.position - self.size + self.rng.choice(self.size, batch_size, replace=False)) % self.capacity
+
+
+def sample_mixed(memory, memory_model, batch_size, real_ratio, out):
+    """Samples real_ratio * batch_size transitions from memory and the rest from memory_model, gathering both directly
+    into one float32 batch instead of sampling them separately and concatenating.
+
+    Parameters
+    ----------
+    memory : ReplayMemory
+    memory_model : ReplayMemory or None
+        If None (or empty, or real_ratio is None), the whole batch is sampled from memory.
+    batch_size : int
+    real_ratio : float or None
+    out : dict
+        Output arrays reused across calls, (re)allocated here when the batch shape changes. The returned batch is a view
+        of them so it's only valid until the next call.
+
+    Returns
+    -------
+    batch : tuple
+        Same as `ReplayMemory.sample`. Fields missing from either buffer are None.
+    idxs : ndarray
+        Indices of the transitions sampled from memory.
+    weights : ndarray or None
+        Importance-sampling weights if memory is a PrioritizedReplayMemory (1 for model transitions), else None.
+    """
+
+    shapes = memory.field_shapes()
+    if memory_model and real_ratio:
+        # Never ask for more rows than the buffers hold, e.g. if memory_model evicted rows since real_ratio was computed
+        n_real, n_model = min(int(real_ratio * batch_size), len(memory)), min(int((1 - real_ratio) * batch_size), len(memory_model))
+        model_shapes = memory_model.field_shapes()
+        fields = [name for name in FIELDS if name in shapes and name in model_shapes]
+    else:
+        n_real, n_model = min(batch_size, len(memory)), 0
+        fields = [name for name in FIELDS if name in shapes]
+    n = n_real + n_model
+
+    for name in fields:
+        shape = (n,) + shapes[name]
+        if name not in out or out[name].shape != shape:
+            out[name] = np.zeros(shape, dtype=np.float32)
+
+    if isinstance(memory, PrioritizedReplayMemory):
+        idxs, weights = memory._sample_prioritized_idxs(n_real)
+        weights = np.concatenate((weights, np.ones(n_model)))
+    else:
+        idxs, weights = memory._sample_idxs(n_real), None
+    memory._get_batch(idxs, tuple(out[name][:n_real] if name in fields else None for name in FIELDS))
+    if n_model > 0:
+        memory_model._get_batch(memory_model._sample_idxs(n_model), tuple(out[name][n_real:] if name in fields else None for name in FIELDS))
+
+    return tuple(out[name] if name in fields else None for name in FIELDS), idxs, weights
+
+
+def _take(column, idxs, out):
+    """Gathers column[idxs] into out, in a single pass when numpy allows np.take to cast into out's dtype."""
+    if np.can_cast(out.dtype, column.dtype):
+        np.take(column, idxs, axis=0, out=out)
+    else:
+        out[...] = column[idxs]
+    return out
+
@@ -0,0 +1,123 @@
+import queue
+import threading
+import torch
+from rcbf_sac.replay_memory import PrioritizedReplayMemory, sample_mixed
+
+
+def batch_to_tensors(batch, device, pin_memory=False):
+    """Converts a batch sampled from the replay buffers to float32 tensors on device.
+
+    Rewards and masks are returned with shape (batch_size, 1) and fields that weren't sampled stay None.
+    """
+
+    tensors = []
+    for i, values in enumerate(batch):
+        if values is None:
+            tensors.append(None)
+            continue
+        if pin_memory:  # page-locked staging copy so the transfer to the GPU can be asynchronous
+            tensor = torch.empty(values.shape, dtype=torch.float32, pin_memory=True)
+            tensor.copy_(torch.from_numpy(values))
+            tensor = tensor.to(device, non_blocking=True)
+        else:
+            tensor = torch.tensor(values, dtype=torch.float32, device=device)
+        if i in (2, 4):  # reward, mask
+            tensor = tensor.unsqueeze(1)
+        tensors.append(tensor)
+    return tuple(tensors)
+
+
+class ReplayPrefetcher:
+    """Samples batches from the replay buffers in a worker thread and keeps a bounded queue of them, already converted
+    to float32 tensors on the training device, so that each update only has to pop one.
+
+    Anything that modifies the buffers while the worker is running (pushes, rollouts, priority updates) should hold
+    `lock`. The batch size and real_ratio used by the worker can be changed at any time through the attributes.
+
+    Queued batches can outlive the rows they were sampled from: call `invalidate` (holding `lock`) after evicting rows,
+    e.g. when `GenerationalReplayMemory.set_generation` returns a non-zero count. With prioritized replay, batches whose
+    real rows were overwritten since sampling are dropped by `get` since their priorities can't be updated anymore.
+    """
+
+    def __init__(self, memory, memory_model, batch_size, device, queue_depth=4):
+
+        self.memory = memory
+        self.memory_model = memory_model
+        self.batch_size = batch_size
+        self.real_ratio = None
+        self.device = device
+        self.pin_memory = device.type == 'cuda'
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.epoch = 0  # bumped by invalidate, batches sampled in an older epoch are dropped
+        self.n_dropped = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def get(self):
+        """Returns the next (batch, real_idxs, weights) with the same layout as `sample_mixed`, as tensors."""
+        self.start()
+        while True:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            stamp, item = item
+            if not self._is_stale(stamp, item[1]):
+                return item
+            self.n_dropped += 1
+
+    def invalidate(self):
+        """Drops the queued batches, and the one being sampled if any. Must be called holding `lock`."""
+        self.epoch += 1
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def _is_stale(self, stamp, real_idxs):
+        epoch, position, n_written = stamp
+        if epoch != self.epoch:
+            return True
+        if real_idxs is not None and isinstance(self.memory, PrioritizedReplayMemory):
+            with self.lock:
+                return self.memory.overwritten_since(real_idxs, position, n_written).any()
+        return False
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _worker(self):
+
+        out = dict()
+        while not self.stop_event.is_set():
+            try:
+                with self.lock:
+                    batch, real_idxs, weights = sample_mixed(self.memory, self.memory_model, self.batch_size, self.real_ratio, out)
+                    stamp = (self.epoch, self.memory.position, self.memory.n_written)
+                    # Convert before releasing the lock since `out` is reused for the next batch
+                    batch = batch_to_tensors(batch, self.device, self.pin_memory)
+                if weights is not None:
+                    weights = torch.from_numpy(weights).float().unsqueeze(1).to(self.device)
+                item = (stamp, (batch, real_idxs, weights))
+            except Exception as e:  # Surface sampling errors in the training thread
+                item = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Exception):
+                return
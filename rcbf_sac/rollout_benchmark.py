@@ -0,0 +1,72 @@
+""" Benchmarks one model rollout step (predict the next state, sample it, rebuild the observation, reward and done) with
+model_step against the fused ModelRolloutStep, as the batch size grows.
+
+Example:
+    python -m rcbf_sac.rollout_benchmark --env Unicycle --batch_sizes 25 256 4096 --gp_points 500
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+from rcbf_sac.dynamics import DynamicsModel
+from rcbf_sac.generate_rollouts import model_step, ModelRolloutStep
+
+
+def make_env(env_name):
+
+    if env_name == 'Unicycle':
+        from envs.unicycle_env import UnicycleEnv
+        return UnicycleEnv()
+    elif env_name == 'SimulatedCars':
+        from envs.simulated_cars_env import SimulatedCarsEnv
+        return SimulatedCarsEnv()
+    raise Exception('Unknown env {}'.format(env_name))
+
+
+def benchmark(env, dynamics_model, batch_size, args):
+
+    rng = np.random.default_rng(args.seed)
+    obs_batch = np.tile(env.reset()[0], (batch_size, 1))
+    action_batch = rng.uniform(env.action_space.low, env.action_space.high, size=(batch_size, env.action_space.shape[0]))
+    t_batch = np.zeros(batch_size)
+    # Spread the initial observations out a bit
+    obs_batch, _, _, _ = model_step(env, dynamics_model, obs_batch, action_batch, t_batch)
+
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        model_step(env, dynamics_model, obs_batch, action_batch, t_batch)
+    reference_time = (time.perf_counter() - start) / args.n_steps
+
+    rollout_step = ModelRolloutStep(env, dynamics_model, batch_size)
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        rollout_step(obs_batch, action_batch, t_batch)
+    fused_time = (time.perf_counter() - start) / args.n_steps
+
+    return reference_time, fused_time
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--env', type=str, default='Unicycle', choices=['Unicycle', 'SimulatedCars'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[25, 256, 4096])
+    parser.add_argument('--n_steps', type=int, default=200, help='Number of steps to average over')
+    parser.add_argument('--gp_points', type=int, default=0, help='Fit the GPs to this many random points first, 0 uses the prior')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    env = make_env(args.env)
+    dynamics_model = DynamicsModel(env, argparse.Namespace(gp_model_size=max(args.gp_points, 1), cuda=False, l_p=0.03))
+    if args.gp_points:
+        rng = np.random.default_rng(args.seed)
+        states = rng.normal(size=(args.gp_points, dynamics_model.n_s))
+        dynamics_model.append_transition(states, np.zeros((args.gp_points, dynamics_model.n_u)), states + env.dt * 0.1 * np.sin(states))
+
+    print('{:>8} {:>16} {:>12} {:>8}'.format('batch', 'model_step (ms)', 'fused (ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        reference_time, fused_time = benchmark(env, dynamics_model, batch_size, args)
+        print('{:>8} {:>16.3f} {:>12.3f} {:>8.2f}'.format(batch_size, 1e3 * reference_time, 1e3 * fused_time, reference_time / fused_time))
@@ -6,6 +6,8 @@ from rcbf_sac.model import GaussianPolicy, QNetwork, DeterministicPolicy
 from rcbf_sac.diff_cbf_qp import CBFQPLayer
 from rcbf_sac.utils import to_tensor
 from rcbf_sac.compensator import Compensator
+from rcbf_sac.replay_memory import sample_mixed
+from rcbf_sac.replay_prefetcher import batch_to_tensors
 import numpy as np
 
 
@@ -48,6 +50,9 @@ class RCBF_SAC(object):
             self.policy = DeterministicPolicy(num_inputs, action_space.shape[0], args.hidden_size, action_space).to(self.device)
             self.policy_optim = Adam(self.policy.parameters(), lr=args.lr)
 
+        # Preallocated batch sampled from the replay buffers on every update
+        self.batch_buffers = dict()
+
         # CBF layer
         self.env = env
         self.cbf_layer = None
@@ -102,12 +107,14 @@ class RCBF_SAC(object):
             final_action = final_action.detach().cpu().numpy()[0] if expand_dim else final_action.detach().cpu().numpy()
             return final_action, action_comp, cbf_action
 
-    def update_parameters(self, memory, batch_size, updates, dynamics_model, memory_model=None, real_ratio=None):
+    def update_parameters(self, memory, batch_size, updates, dynamics_model, memory_model=None, real_ratio=None, prefetcher=None):
         """
 
         Parameters
         ----------
         memory : ReplayMemory
+                If a PrioritizedReplayMemory, the critic losses are importance-sampling weighted and the priorities of
+                the sampled transitions are updated with their TD errors.
         batch_size : int
         updates : int
         dynamics_model : GP Dynamics' Disturbance model D(x) in x_dot = f(x) + g(x)u + D(x)
@@ -116,6 +123,8 @@ class RCBF_SAC(object):
         real_ratio : float, optional
                 If performing model-based RL, then real_ratio*batch_size are sampled from the real buffer, and the rest
                 is sampled from the model buffer.
+        prefetcher : ReplayPrefetcher, optional
+                If given, the batch is popped from its queue instead of being sampled here.
 
         Returns
         -------
@@ -123,32 +132,17 @@ class RCBF_SAC(object):
         """
 
 
-        # Model-based vs regular RL
-        if memory_model and real_ratio:
-            state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch, next_t_batch, cbf_info_batch, next_cbf_info_batch = memory.sample(
-                batch_size=int(real_ratio * batch_size))
-            state_batch_m, action_batch_m, reward_batch_m, next_state_batch_m, mask_batch_m, t_batch_m, next_t_batch_m, cbf_info_batch_m, next_cbf_info_batch_m = memory_model.sample(
-                batch_size=int((1 - real_ratio) * batch_size))
-            state_batch = np.vstack((state_batch, state_batch_m))
-            action_batch = np.vstack((action_batch, action_batch_m))
-            reward_batch = np.hstack((reward_batch, reward_batch_m))
-            next_state_batch = np.vstack((next_state_batch, next_state_batch_m))
-            mask_batch = np.hstack((mask_batch, mask_batch_m))
-            if cbf_info_batch is not None and cbf_info_batch[0] is not None:
-                cbf_info_batch = np.hstack((cbf_info_batch, cbf_info_batch_m))
-                next_cbf_info_batch = np.hstack((next_cbf_info_batch, next_cbf_info_batch_m))
+        # Sample real and model transitions into one batch. Prioritized replay only applies to the real buffer, model
+        # transitions get unit weights
+        if prefetcher:
+            batch, real_idxs, weights_batch = prefetcher.get()
         else:
-            state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch, next_t_batch, cbf_info_batch, next_cbf_info_batch = memory.sample(batch_size=batch_size)
-
-
-        state_batch = torch.FloatTensor(state_batch).to(self.device)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.device)
-        action_batch = torch.FloatTensor(action_batch).to(self.device)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        mask_batch = torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
-        if cbf_info_batch is not None and cbf_info_batch[0] is not None:
-            cbf_info_batch = torch.FloatTensor(cbf_info_batch).to(self.device)
-            next_cbf_info_batch = torch.FloatTensor(next_cbf_info_batch).to(self.device)
+            batch, real_idxs, weights_batch = sample_mixed(memory, memory_model, batch_size, real_ratio, self.batch_buffers)
+            batch = batch_to_tensors(batch, self.device)
+            if weights_batch is not None:
+                weights_batch = torch.FloatTensor(weights_batch).to(self.device).unsqueeze(1)
+        state_batch, action_batch, reward_batch, next_state_batch, mask_batch, t_batch, next_t_batch, cbf_info_batch, next_cbf_info_batch = batch
+        prioritized = weights_batch is not None
 
         with torch.no_grad():
             next_state_action, next_state_log_pi, _ = self.policy.sample(next_state_batch)
@@ -158,8 +152,19 @@ class RCBF_SAC(object):
             min_qf_next_target = torch.min(qf1_next_target, qf2_next_target) - self.alpha * next_state_log_pi
             next_q_value = reward_batch + mask_batch * self.gamma * (min_qf_next_target)
         qf1, qf2 = self.critic(state_batch, action_batch)  # Two Q-functions to mitigate positive bias in the policy improvement step
-        qf1_loss = F.mse_loss(qf1, next_q_value)  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
-        qf2_loss = F.mse_loss(qf2, next_q_value)  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
+        if prioritized:  # Importance-sampling weighted losses, and new priorities from the TD errors
+            qf1_loss = (weights_batch * (qf1 - next_q_value) ** 2).mean()
+            qf2_loss = (weights_batch * (qf2 - next_q_value) ** 2).mean()
+            td_errors = 0.5 * (torch.abs(qf1 - next_q_value) + torch.abs(qf2 - next_q_value))
+            td_errors = td_errors[:real_idxs.shape[0], 0].detach().cpu().numpy()
+            if prefetcher:
+                with prefetcher.lock:
+                    memory.update_priorities(real_idxs, td_errors)
+            else:
+                memory.update_priorities(real_idxs, td_errors)
+        else:
+            qf1_loss = F.mse_loss(qf1, next_q_value)  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
+            qf2_loss = F.mse_loss(qf2, next_q_value)  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
         qf_loss = qf1_loss + qf2_loss
 
         self.critic_optim.zero_grad()
@@ -0,0 +1,46 @@
+import argparse
+import threading
+import numpy as np
+import torch
+from envs.unicycle_env import UnicycleEnv
+from rcbf_sac.dynamics import DynamicsModel
+
+
+def test_incremental_update_when_async_refit_is_skipped():
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    env = UnicycleEnv()
+    dynamics_model = DynamicsModel(env, argparse.Namespace(gp_model_size=50, cuda=False, l_p=0.03, gp_async=True, gp_incremental=True))
+    rng = np.random.default_rng(0)
+
+    def append(states, disturbance):
+        n = states.shape[0]
+        actions = np.zeros((n, dynamics_model.n_u))
+        next_states = states + env.dt * (dynamics_model.get_f(states) + disturbance)
+        return dynamics_model.append_transition(states, actions, next_states)
+
+    train_states = rng.normal(size=(50, dynamics_model.n_s))
+    append(train_states, 0.1 * np.sin(train_states))
+    dynamics_model.wait_for_fit()
+
+    # Keep a background fit running so that the next due refit is skipped
+    release = threading.Event()
+    dynamics_model.fit_thread = threading.Thread(target=release.wait, daemon=True)
+    dynamics_model.fit_thread.start()
+    try:
+        n_points = dynamics_model.disturb_estimators[0].train_y.shape[-1]
+        states = rng.normal(size=(5, dynamics_model.n_s))
+        disturb_mean_before, _ = dynamics_model.predict_disturbance(states)
+        n_refits, n_skipped_refits = append(states, 1.)  # reaches the next refit, due every 50 / 10 points
+    finally:
+        release.set()
+    dynamics_model.wait_for_fit()
+
+    assert (n_refits, n_skipped_refits) == (0, 1)
+    assert dynamics_model.gp_posterior_updates == 1
+    # The current GPs were conditioned on the new points
+    for estimator in dynamics_model.disturb_estimators:
+        assert estimator.train_y.shape[-1] == n_points + 5
+    disturb_mean, _ = dynamics_model.predict_disturbance(states)
+    assert np.all((disturb_mean - disturb_mean_before)[:, dynamics_model.gp_dims] > 0.01)  # towards the new disturbance
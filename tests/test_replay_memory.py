@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from rcbf_sac.replay_memory import ReplayMemory, GenerationalReplayMemory, FIELDS
+
+
+def unicycle_transitions(n, rng):
+    """Transitions with observations in the ranges of the Unicycle env."""
+    thetas = rng.uniform(-np.pi, np.pi, n)
+    obs = np.stack((rng.uniform(-3., 3., n), rng.uniform(-3., 3., n), np.cos(thetas), np.sin(thetas),
+                    np.cos(thetas), np.sin(thetas), np.exp(-rng.uniform(0., 8.5, n))), axis=1)
+    times = rng.uniform(0., 40., n)
+    return obs, rng.uniform(-1., 1., (n, 2)), rng.normal(size=n), obs[::-1].copy(), rng.random(n) > 0.1, times, times + 0.02
+
+
+def simulated_cars_transitions(n, rng):
+    """Transitions with observations in the ranges of the SimulatedCars env (scaled positions and velocities)."""
+    obs = np.zeros((n, 10))
+    obs[:, ::2] = rng.uniform(0., 250., (n, 5)) / 100.0
+    obs[:, 1::2] = rng.uniform(0., 45., (n, 5)) / 30.0
+    times = rng.uniform(0., 40., n)
+    return obs, rng.uniform(-1., 1., (n, 1)), rng.normal(size=n), obs[::-1].copy(), rng.random(n) > 0.1, times, times + 0.02
+
+
+@pytest.mark.parametrize('make_transitions', [unicycle_transitions, simulated_cars_transitions])
+def test_compressed_reconstruction_error(make_transitions):
+
+    n = 10000
+    transitions = make_transitions(n, np.random.default_rng(0))
+    memory = ReplayMemory(n, 0, compress=True)
+    memory.batch_push(*transitions)
+    batch = memory._get_batch(np.arange(n))
+
+    # Rounding error of each storage dtype: half an ulp relative to the value, and half the smallest subnormal near 0
+    tolerances = {np.float16: (2 ** -11, 2 ** -25), np.float32: (2 ** -24, 2 ** -150)}
+    for name, pushed, sampled in zip(FIELDS, transitions, batch):
+        if name in memory.dtypes and name != 'mask' and pushed is not None:
+            assert sampled.dtype == np.float64
+            rtol, atol = tolerances[memory.dtypes[name]]
+            np.testing.assert_allclose(sampled, pushed, rtol=rtol, atol=atol, err_msg=name)
+
+    state, _, _, _, _, t, _, _, _ = batch
+    if make_transitions is unicycle_transitions:
+        theta_err = np.abs(np.arctan2(state[:, 3], state[:, 2]) - np.arctan2(transitions[0][:, 3], transitions[0][:, 2]))
+        assert np.minimum(theta_err, 2 * np.pi - theta_err).max() < 1e-3
+    # SimulatedCars' dynamics depend on sin(0.2 * t), so t has to stay accurate over a whole episode
+    assert np.abs(t - transitions[5]).max() < 1e-5
+
+
+def test_compressed_mask_round_trips_exactly():
+
+    rng = np.random.default_rng(0)
+    memory = ReplayMemory(1000, 0, compress=True)
+    transitions = unicycle_transitions(700, rng)
+    memory.batch_push(*transitions)
+    obs, action, reward, next_obs, mask, t, next_t = unicycle_transitions(1, rng)
+    memory.push(obs[0], action[0], reward[0], next_obs[0], False, t[0], next_t[0])
+    memory.push(obs[0], action[0], reward[0], next_obs[0], True, t[0], next_t[0])
+
+    assert memory.columns['mask'].dtype == np.uint8
+    sampled_mask = memory._get_batch(np.arange(702))[4]
+    assert np.array_equal(sampled_mask, np.concatenate((transitions[4], [False, True])))
+    assert np.array_equal(sampled_mask.astype(bool), sampled_mask)  # exactly 0 or 1
+
+
+@pytest.mark.parametrize('capacity', [1000, 600])
+def test_compressed_save_load_is_lossless(tmp_path, capacity):
+
+    memory = ReplayMemory(capacity, 0, compress=True)
+    rng = np.random.default_rng(0)
+    for _ in range(4):  # wraps around the ring
+        memory.batch_push(*unicycle_transitions(250, rng))
+    memory.sample(32)  # moves the rng
+    memory.save(str(tmp_path))
+
+    loaded = ReplayMemory(capacity, 1, compress=True)
+    assert loaded.load(str(tmp_path))
+    assert len(loaded) == len(memory)
+    assert {name: column.dtype for name, column in loaded.columns.items()} == {name: column.dtype for name, column in memory.columns.items()}
+
+    # Same rows oldest to newest, bit for bit
+    order = (memory.position - memory.size + np.arange(memory.size)) % memory.capacity
+    for name, column in memory.columns.items():
+        assert np.array_equal(loaded.columns[name][:loaded.size], column[order]), name
+    # and it samples the same rows afterwards
+    assert loaded.rng.bit_generator.state == memory.rng.bit_generator.state
+
+
+def test_generational_segments_track_live_rows():
+
+    memory = GenerationalReplayMemory(100, 0, retention=3)
+    rng = np.random.default_rng(0)
+    for generation in range(20):
+        memory.set_generation(generation)
+        for _ in range(rng.integers(1, 4)):
+            n = rng.integers(1, 60)
+            memory.batch_push(*unicycle_transitions(n, rng))
+            memory.push(*(values[0] for values in unicycle_transitions(1, rng)))
+        assert memory.n_segment_rows == sum(n_rows for _, n_rows in memory.segments) == len(memory)
+        assert all(g > generation - 3 for g, _ in memory.segments)
@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+from rcbf_sac.replay_memory import ReplayMemory, PrioritizedReplayMemory, GenerationalReplayMemory
+from rcbf_sac.replay_prefetcher import ReplayPrefetcher
+
+
+def push_rows(memory, values):
+    """Pushes one transition per value, with every field of the transition set to it."""
+    n = len(values)
+    column = np.asarray(values, dtype=np.float64)[:, None]
+    memory.batch_push(column, column, column[:, 0], column, np.ones(n, dtype=bool), column[:, 0], column[:, 0])
+
+
+def test_prefetch_while_evicting_model_rows():
+
+    memory = ReplayMemory(1000, 0)
+    push_rows(memory, -np.ones(1000))
+    memory_model = GenerationalReplayMemory(1000, 0, retention=1)
+    prefetcher = ReplayPrefetcher(memory, memory_model, 64, torch.device('cpu'))
+    prefetcher.real_ratio = 0.25
+    prefetcher.start()
+
+    try:
+        for generation in range(1, 50):
+            with prefetcher.lock:
+                # With a retention of 1 every generation evicts all the rows of the previous one, so the worker would
+                # ask for more model rows than the buffer holds if it didn't cap them
+                if memory_model.set_generation(generation):
+                    prefetcher.invalidate()
+                push_rows(memory_model, np.full(40, generation))
+            for _ in range(3):
+                batch, real_idxs, weights = prefetcher.get()
+                # Batches sampled before the eviction were dropped, so there's no model row of an older generation
+                assert set(np.unique(batch[0].numpy())) <= {-1, generation}
+    finally:
+        prefetcher.close()
+
+
+def test_prefetch_drops_overwritten_prioritized_rows():
+
+    memory = PrioritizedReplayMemory(200, 0)
+    push_rows(memory, np.arange(200))
+    prefetcher = ReplayPrefetcher(memory, None, 32, torch.device('cpu'))
+    prefetcher.start()
+
+    n_pushed = 200
+    try:
+        for _ in range(100):
+            with prefetcher.lock:
+                push_rows(memory, np.arange(n_pushed, n_pushed + 7))  # wraps around the ring every ~30 iterations
+            n_pushed += 7
+            batch, real_idxs, weights = prefetcher.get()
+            # The sampled slots still hold the sampled transitions, so their priorities can be updated
+            with prefetcher.lock:
+                assert np.array_equal(memory.columns['state'][real_idxs, 0], batch[0][:, 0].numpy())
+                memory.update_priorities(real_idxs, np.ones(len(real_idxs)))
+    finally:
+        prefetcher.close()
+    assert prefetcher.n_dropped > 0